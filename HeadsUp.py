@@ -2,47 +2,58 @@
 # Copyright (c) Jeremy P Bentham 2019
 # Please credit iosoft.blog if you use the information or software in it
 import cv2
+import functools
+import math
 import sys
 import threading
 import time
 
 import yaml
-from PyQt5.QtCore import QTimer, pyqtSignal, pyqtSlot, QSize
+from PyQt5.QtCore import pyqtSignal, pyqtSlot, QSize, QTimer
 from PyQt5.QtGui import QFont, QImage
 from PyQt5.QtMultimedia import QCameraInfo
 from PyQt5.QtWidgets import QApplication, QMainWindow, QTabWidget, QToolBar, QComboBox
-from PyQt5.QtWidgets import QWidget, QAction, QVBoxLayout, QHBoxLayout
+from PyQt5.QtWidgets import QWidget, QAction, QVBoxLayout, QHBoxLayout, QGridLayout
 from munch import munchify
 
+from event_log import get_event_log
 from live_widget import LiveWidget
+from recording_catalog import get_catalog
+from pipeline import InferencePool, Pipeline, inference_pool_size
 from playback_widget import VideoPlayer
-from yolo_formatter import YoloVideoSelf
 
 VERSION = "Heads-Up v0.10"
 
-try:
-    import Queue as Queue
-except:
-    import queue as Queue
-
 camera_num = 1
 IMG_SIZE = 1920, 1080  # 640,480 or 1280,720 or 1920,1080    --
-IMG_FORMAT = QImage.Format_RGB888
+IMG_FORMAT = getattr(QImage, 'Format_BGR888', QImage.Format_RGB888)  # BGR888 needs Qt 5.14, saves a conversion
 DISP_SCALE = 2  # Scaling factor for display image
-DISP_MSEC = 50  # Delay between display cycles
 CAP_API = cv2.CAP_ANY  # API: CAP_ANY or CAP_DSHOW etc...
 EXPOSURE = 0  # Zero for automatic exposure
 TEXT_FONT = QFont("Courier", 10)
-image_queue = Queue.Queue()  # Queue to hold images
-capturing = True  # Flag to indicate capturing
+STATUS_MSEC = 1000  # How often the status bar and performance HUD are refreshed
+MODEL_LOAD_SECONDS = 120  # model_preload: startup gives up waiting after this long
 
 
 class MyWindow(QMainWindow):
     text_update = pyqtSignal(str)
+    frame_ready = pyqtSignal(int)  # Index of the camera with a new frame
 
     # Create main window
     def __init__(self, parent=None):
         settings = munchify(yaml.safe_load(open("config/config.yml")))
+        self.settings = settings
+        self.cameras = list(settings.get('cameras') or [])  # More than one: all shown at once in a grid
+        self.pipelines = []
+        self.frame_pending = []
+        self.events = get_event_log(settings)
+        # Loaded and warmed once, kept across camera switches; workers load on their own threads
+        self.pool = InferencePool(settings, inference_pool_size(settings, max(1, len(self.cameras))))
+        self.pool.start()
+        if settings.get('model_preload', 'background') == 'startup':
+            # Raises when the model cannot be loaded, rather than opening a window that never detects
+            if not self.pool.wait_ready(MODEL_LOAD_SECONDS):
+                print("Model still loading after %d s, continuing in the background" % MODEL_LOAD_SECONDS)
 
         # self.deBugLogPorts()
         QMainWindow.__init__(self, parent)
@@ -62,7 +73,6 @@ class MyWindow(QMainWindow):
         camera_toolbar = QToolBar("Camera X")
         camera_toolbar.setIconSize(QSize(14, 14))
         self.addToolBar(camera_toolbar)
-        self.stop_capture_thread = False
         self.available_cameras = QCameraInfo.availableCameras()
         print(self.available_cameras)
         if not self.available_cameras:
@@ -72,6 +82,7 @@ class MyWindow(QMainWindow):
         camera_selector.addItems([c.description() for c in self.available_cameras])
         camera_selector.setCurrentIndex(camera_num)
         camera_selector.currentIndexChanged.connect(self.restart)
+        camera_selector.setEnabled(len(self.cameras) <= 1)
 
         camera_toolbar.addWidget(camera_selector)
 
@@ -82,20 +93,34 @@ class MyWindow(QMainWindow):
 
         # Create first tab
         self.tab1.layout = QVBoxLayout()
-        self.liveWidget = LiveWidget(self)
-        self.tab1.layout.addWidget(self.liveWidget)
+        if len(self.cameras) > 1:
+            self.gridColumns = int(math.ceil(math.sqrt(len(self.cameras))))
+            self.liveGrid = QGridLayout()
+            self.liveWidgets = []
+            for i in range(len(self.cameras)):
+                widget = LiveWidget(self)
+                self.liveGrid.addWidget(widget, i // self.gridColumns, i % self.gridColumns)
+                self.liveWidgets.append(widget)
+            self.tab1.layout.addLayout(self.liveGrid)
+        else:
+            self.gridColumns = 1
+            self.liveWidget = LiveWidget(self)
+            self.liveWidgets = [self.liveWidget]
+            self.tab1.layout.addWidget(self.liveWidget)
         self.tab1.setLayout(self.tab1.layout)
 
         # Create 2nd tab
         self.tab2.layout = QVBoxLayout()
-        self.playBackWidget = VideoPlayer(self, settings.record_folder_poor)
+        self.playBackWidget = VideoPlayer(self, settings.record_folder_poor, get_catalog(settings),
+                                          self.camera_folders(settings.record_folder_poor))
         self.tab2.layout.addWidget(self.playBackWidget)
         self.tab2.setLayout(self.tab2.layout)
 
 
         # Create 3rd tab
         self.tab3.layout = QVBoxLayout()
-        self.playBackWidget = VideoPlayer(self, settings.record_folder_good)
+        self.playBackWidget = VideoPlayer(self, settings.record_folder_good, get_catalog(settings),
+                                          self.camera_folders(settings.record_folder_good))
         self.tab3.layout.addWidget(self.playBackWidget)
         self.tab3.setLayout(self.tab3.layout)
 
@@ -116,6 +141,15 @@ class MyWindow(QMainWindow):
         self.fileMenu = self.mainMenu.addMenu('&File')
         self.fileMenu.addAction(exitAction)
 
+        # Per stage timings over the live video, and a one line summary in the status bar
+        self.hudAction = QAction('Performance &HUD', self, checkable=True)
+        self.hudAction.setChecked(bool(settings.get('performance_hud', False)))
+        self.hudAction.toggled.connect(lambda checked: self.update_status())
+        self.viewMenu = self.mainMenu.addMenu('&View')
+        self.viewMenu.addAction(self.hudAction)
+        self.statusTimer = QTimer(self)
+        self.statusTimer.timeout.connect(self.update_status)
+
     def deBugLogPorts(self):
         is_working = True
         dev_port = 1
@@ -151,93 +185,125 @@ class MyWindow(QMainWindow):
         # Start image capture & display
 
     def start(self):
-        self.timer = QTimer(self)  # Timer to trigger display
-        self.timer.timeout.connect(lambda:
-                                   self.show_image(image_queue, self.liveWidget, DISP_SCALE))
-        self.timer.start(DISP_MSEC)
-        self.stop_capture_thread = False
-        self.capture_thread = threading.Thread(target=grab_images,
-                                               args=(camera_num, image_queue, lambda: self.stop_capture_thread))
-        self.capture_thread.start()  # Thread to grab images
-
-    # Restart image capture & display
+        self.frame_ready.connect(self.show_latest_frame)  # Queued: emitted on the pipeline threads
+        if len(self.cameras) > 1:
+            self.start_cameras(self.cameras)
+        else:
+            self.start_pipeline(self.cameras[0] if self.cameras else camera_num)
+        self.statusTimer.start(STATUS_MSEC)
+
+    # Restart image capture & display. The old pipeline winds down in the background,
+    # the new one reuses the warm networks of the pool
     def restart(self, i):
-        self.stop_capture_thread = True
-        time.sleep(1)
-        self.stop_capture_thread = False
-        self.capture_thread = threading.Thread(target=grab_images,
-                                               args=(i, image_queue, lambda: self.stop_capture_thread))
-        self.capture_thread.start()  # Thread to grab images
-
-    # Fetch camera image from queue, and display it
-    def show_image(self, imageq, display, scale):
-        if not imageq.empty():
-            image = imageq.get()
-            if image is not None and len(image) > 0:
-                img = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-                self.display_image(img, display, scale)
-
-    # Display an image, reduce size if required
-    def display_image(self, img, display, scale=1):
-        disp_size = img.shape[1] // scale, img.shape[0] // scale
-        disp_bpl = disp_size[0] * 3
-        if scale > 1:
-            img = cv2.resize(img, disp_size, interpolation=cv2.INTER_CUBIC)
-        qimg = QImage(img.data, disp_size[0], disp_size[1], disp_bpl, IMG_FORMAT)
-        display.setImage(qimg)
-
-    # Handle sys.stdout.write: update text display
+        self.stop_pipeline(wait=False)
+        self.start_pipeline(i)
+
+    def start_pipeline(self, cam_num):
+        self.frame_pending = [threading.Event()]
+        self.pipelines = [Pipeline(cam_num, IMG_SIZE, EXPOSURE, DISP_SCALE, functools.partial(self.notify_frame, 0),
+                                   self.pool, settings=self.settings)]
+        self.pipelines[0].start()
+
+    # Several cameras share the inference pool, each grid cell is scaled down further
+    def start_cameras(self, cameras):
+        print("%d cameras, %d inference workers" % (len(cameras), self.pool.workers))
+        self.frame_pending = [threading.Event() for _ in cameras]
+        self.pipelines = [Pipeline(cam_num, IMG_SIZE, EXPOSURE, DISP_SCALE * self.gridColumns,
+                                   functools.partial(self.notify_frame, i), self.pool, self.camera_name(i, cam_num),
+                                   settings=self.settings)
+                          for i, cam_num in enumerate(cameras)]
+        for pipeline in self.pipelines:
+            pipeline.start()
+
+    # Recording folder suffix: camera<number>, or source<grid position> for a video file or synthetic
+    # source, so the two can never share a folder
+    def camera_name(self, index, cam_num):
+        return 'camera%d' % cam_num if isinstance(cam_num, int) else 'source%d' % index
+
+    # (name, folder) of every camera's recordings in folder, as YoloVideoSelf names them; None with one camera
+    def camera_folders(self, folder):
+        if len(self.cameras) <= 1:
+            return None
+        return [(self.camera_name(i, cam_num), folder + '_' + self.camera_name(i, cam_num))
+                for i, cam_num in enumerate(self.cameras)]
+
+    # wait=False hands the pipelines to a thread, joining them and flushing their recordings
+    # takes a while and must not hold up the GUI
+    def stop_pipeline(self, wait=True):
+        pipelines, self.pipelines = self.pipelines, []
+        for pipeline in pipelines:
+            pipeline.on_frame = None  # Its frames no longer belong to any widget
+        if wait:
+            self.retire_pipelines(pipelines)
+        else:
+            threading.Thread(target=self.retire_pipelines, args=(pipelines,), name='retire', daemon=True).start()
+
+    def retire_pipelines(self, pipelines):
+        for pipeline in pipelines:
+            pipeline.stop()
+            print(pipeline.report())
+
+    # Pipeline thread: a frame is ready. Only signal if the GUI has not been told already,
+    # frames arriving before it catches up are coalesced into one update of the newest frame
+    def notify_frame(self, index):
+        pending = self.frame_pending[index]
+        if not pending.is_set():
+            pending.set()
+            self.frame_ready.emit(index)
+
+    @pyqtSlot(int)
+    def show_latest_frame(self, index):
+        if index >= len(self.pipelines):  # Queued from a pipeline that has since been stopped
+            return
+        self.frame_pending[index].clear()
+        self.show_image(self.pipelines[index], self.liveWidgets[index])
+
+    # Fetch the newest annotated frame from the pipeline, and display it
+    def show_image(self, pipeline, display):
+        image = pipeline.get_display_frame()
+        if image is not None and len(image) > 0:
+            self.display_image(image, display)
+
+    def update_status(self):
+        status = []
+        for pipeline, widget in zip(self.pipelines, self.liveWidgets):
+            grab, inference, display = (pipeline.stats[name] for name in ('grab', 'inference', 'display'))
+            status.append("%s %.1f fps, inference p95 %.0f ms, latency p50 %.0f ms" % (
+                pipeline.camera_name or 'camera', grab.fps(), inference.percentiles()[1],
+                display.percentiles()[0]))
+            widget.setHud(pipeline.hud_lines() if self.hudAction.isChecked() else [])
+        if self.pipelines:
+            status.append("cpu %.0f%%" % self.pipelines[0].cpu_percent('status'))  # Whole process
+        if self.pool.error is not None and self.pool.loaded < self.pool.workers:
+            status.insert(0, "Model failed to load: %s" % self.pool.error)
+        elif self.pool.error is not None:
+            status.insert(0, "Inference failing: %s" % self.pool.error)
+        elif not self.pool.ready.is_set():
+            status.insert(0, "Loading model %d/%d" % (self.pool.loaded, self.pool.workers))
+        self.statusBar().showMessage(' | '.join(status))
+
+    # Display a BGR image, already scaled down by the pipeline
+    def display_image(self, img, display):
+        if IMG_FORMAT == QImage.Format_RGB888:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        qimg = QImage(img.data, img.shape[1], img.shape[0], img.strides[0], IMG_FORMAT)
+        display.setImage(qimg, img)
+
+    # Handle sys.stdout.write: update text display, and keep the text in the event log
     def write(self, text):
         self.text_update.emit(str(text))
-        with open('log.txt', 'a') as f:
-            f.write(text)
-            f.close()
+        if text.strip():
+            self.events.log('console', text=text.rstrip())
 
     def flush(self):
         pass
 
     # Window is closing: stop video capture
     def closeEvent(self, event):
-        global capturing
-        capturing = False
-        self.capture_thread.join()
-
-
-# Grab images from the camera (separate thread)
-def grab_images(cam_num, queue, stop, self=None):
-    capture = cv2.VideoCapture(cam_num)
-    time.sleep(0.5)  # Need this timer here for MackBookPro Camera to work
-    neural_network = cv2.dnn.readNet("config/yolov4-tiny_best-5.weights", "config/yolov4-tiny-5.cfg")
-    neural_network.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
-    neural_network.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
-    yoloVideoSelf = YoloVideoSelf()
-    yoloVideoSelf.width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH) + 0.5)
-    yoloVideoSelf.height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT) + 0.5)
-    # Codec = 7634706D in HEX
-    yoloVideoSelf.codec = cv2.VideoWriter_fourcc(*'mp4v')  # Be sure to use the lower case
-
-    capture.set(cv2.CAP_PROP_FRAME_WIDTH, IMG_SIZE[0])
-    capture.set(cv2.CAP_PROP_FRAME_HEIGHT, IMG_SIZE[1])
-    if EXPOSURE:
-        capture.set(cv2.CAP_PROP_AUTO_EXPOSURE, 0)
-        capture.set(cv2.CAP_PROP_EXPOSURE, EXPOSURE)
-    else:
-        capture.set(cv2.CAP_PROP_AUTO_EXPOSURE, 1)
-    while capturing:
-        if capture.grab():
-            retval, image = capture.retrieve(0)
-            if image is not None and queue.qsize() < 2:
-                yoloVideoSelf.processFrame(image, neural_network)
-                queue.put(image)
-            else:
-                time.sleep(DISP_MSEC / 1000.0)
-        else:
-            print("Error: can't grab camera image")
-            break
-
-        if stop():
-            break
-    capture.release()
+        self.statusTimer.stop()
+        self.stop_pipeline()
+        self.pool.stop()
+        self.events.flush()
 
 
 if __name__ == '__main__':
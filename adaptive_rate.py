@@ -0,0 +1,55 @@
+import threading
+
+
+class FixedRateScheduler:
+    """Decides which frames get a fresh detection: every Nth one."""
+
+    def __init__(self, every=1):
+        self.interval = max(0, every - 1)  # Frames to skip between detections
+        self.skipped = 0
+        self.held = 0  # Total frames that went without a detection
+        self._lock = threading.Lock()
+
+    def should_detect(self):
+        with self._lock:
+            if self.skipped >= self.interval:
+                self.skipped = 0
+                return True
+            self.skipped += 1
+            self.held += 1
+            return False
+
+    # Called with the angle of every freshly detected frame, None if ear or nose was missing
+    def update(self, angle):
+        pass
+
+
+class AdaptiveRateScheduler(FixedRateScheduler):
+    """Decides which frames get a fresh detection from how the posture is changing.
+
+    While the ear-nose angle is stable and well inside the posterior/anterior limits the
+    number of frames between detections doubles after every detection, up to max_skip.
+    Once the angle moves, gets within margin degrees of a limit, or the head is lost,
+    every frame is detected again.
+    """
+
+    def __init__(self, posterior_angle, anterior_angle, max_skip=8, margin=5, stable_delta=2):
+        super(AdaptiveRateScheduler, self).__init__()
+        self.posterior_angle = posterior_angle
+        self.anterior_angle = anterior_angle
+        self.max_skip = max_skip
+        self.margin = margin
+        self.stable_delta = stable_delta
+        self.last_angle = None
+
+    def update(self, angle):
+        with self._lock:
+            if angle is None or self.last_angle is None:
+                self.interval = 0
+            else:
+                margin = min(angle - self.posterior_angle, self.anterior_angle - angle)
+                if margin < self.margin or abs(angle - self.last_angle) > self.stable_delta:
+                    self.interval = 0
+                else:
+                    self.interval = min(self.max_skip, max(1, self.interval * 2))
+            self.last_angle = angle
@@ -0,0 +1,117 @@
+import collections
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+
+class SoundSink:
+    """Plays a sound file with whatever the platform offers, falling back to the terminal bell."""
+    name = 'sound'
+
+    def __init__(self, sound_file="3.wav"):
+        self.sound_file = sound_file
+        self.command = None
+        if sys.platform == 'darwin':
+            self.command = ['afplay']
+        else:
+            for player in (['paplay'], ['aplay', '-q'], ['ffplay', '-nodisp', '-autoexit', '-loglevel', 'quiet']):
+                if shutil.which(player[0]):
+                    self.command = player
+                    break
+
+    def send(self, message):
+        if sys.platform == 'win32':
+            import winsound
+            winsound.PlaySound(self.sound_file, winsound.SND_FILENAME | winsound.SND_ASYNC)
+        elif self.command is not None:
+            # Not waited for, the player exits on its own once the sound is done
+            subprocess.Popen(self.command + [self.sound_file], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        else:
+            sys.stderr.write('\a')
+            sys.stderr.flush()
+
+
+class NotificationSink:
+    """Desktop notification via osascript (macOS) or notify-send (Linux)."""
+    name = 'notification'
+
+    def send(self, message):
+        if sys.platform == 'darwin':
+            command = ['osascript', '-e', 'display notification "%s" with title "Heads-Up"' % message]
+        elif shutil.which('notify-send'):
+            command = ['notify-send', 'Heads-Up', message]
+        else:
+            print("************ Heads-Up: %s ************" % message)
+            return
+        subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+class AlertDispatcher:
+    """Delivers alerts to its sinks on a background thread so raising one never blocks frame
+    processing. Alerts closer together than min_interval seconds are suppressed and counted."""
+
+    SINKS = {SoundSink.name: SoundSink, NotificationSink.name: NotificationSink}
+
+    def __init__(self, sinks, min_interval=10.0):
+        self.sinks = sinks
+        self.min_interval = min_interval
+        self.sent = 0
+        self.suppressed = 0
+        self._last_alert = None
+        self._pending = collections.deque()
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='alerts', daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def from_settings(cls, settings):
+        sinks = []
+        for name in settings.get('alert_sinks', ['sound']):
+            if name == SoundSink.name:
+                sinks.append(SoundSink(settings.get('alert_sound', "3.wav")))
+            elif name in cls.SINKS:
+                sinks.append(cls.SINKS[name]())
+            else:
+                print("Unknown alert sink '%s', expected one of %s" % (name, ', '.join(cls.SINKS)))
+        return cls(sinks, settings.get('alert_min_interval', 10.0))
+
+    # Returns False when the alert was rate limited
+    def alert(self, message):
+        now = time.monotonic()
+        with self._cond:
+            if self._last_alert is not None and now - self._last_alert < self.min_interval:
+                self.suppressed += 1
+                return False
+            self._last_alert = now
+            self._pending.append(message)
+            self._cond.notify()
+        return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                message = self._pending.popleft()
+            for sink in self.sinks:
+                try:
+                    sink.send(message)
+                except Exception as e:
+                    print("Error: alert sink %s failed: %s" % (sink.name, e))
+            self.sent += 1
+
+
+_dispatcher_lock = threading.Lock()
+_dispatcher = None
+
+
+def get_alerts(settings):
+    """The AlertDispatcher of the process, shared by every camera and pipeline, so restarting one
+    neither leaks a thread nor resets the rate limit."""
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = AlertDispatcher.from_settings(settings)
+        return _dispatcher
@@ -0,0 +1,148 @@
+# Headless posture analysis of recorded videos
+#
+# Runs the posture detection and angle logic over .mp4 recordings without the GUI,
+# one network per worker process, and writes per-frame angles and posture events as CSV.
+#
+# Usage (from the repository root):
+#   python batch_analysis.py record good39 --workers 4 --batch-size 4 --output analysis.csv
+import argparse
+import csv
+import glob
+import multiprocessing
+import os
+import time
+
+import cv2
+import yaml
+from munch import munchify
+
+import posture
+from yolo_model import YoloModel
+
+VIDEO_PATTERNS = ('*.mp4', '*.avi', '*.mov')
+FRAME_FIELDS = ['file', 'frame', 'time', 'ear_x', 'ear_y', 'nose_x', 'nose_y', 'angle', 'posture']
+EVENT_FIELDS = ['file', 'frame', 'time', 'event', 'angle']
+
+# Per worker process, loaded once by init_worker
+_model = None
+_batch_size = 1
+
+
+def find_videos(paths):
+    videos = []
+    for path in paths:
+        if os.path.isdir(path):
+            for pattern in VIDEO_PATTERNS:
+                videos.extend(glob.glob(os.path.join(path, pattern)))
+        elif os.path.isfile(path):
+            videos.append(path)
+        else:
+            print("Skipping %s: no such file or directory" % path)
+    return sorted(videos)
+
+
+def init_worker(cv_threads, batch_size):
+    global _model, _batch_size
+    _batch_size = batch_size
+    cv2.setNumThreads(cv_threads)  # Share the cores between the worker processes
+    settings = munchify(yaml.safe_load(open("config/config.yml")))
+    _model = YoloModel.from_settings(settings)
+
+
+class PostureEvents:
+    """The poor posture timer of the live app (posture.PostureTimer), run on video time."""
+
+    def __init__(self, file):
+        self.file = file
+        self.timer = posture.PostureTimer()
+        self.events = []
+
+    def update(self, frame_index, timestamp, angle):
+        if angle is None:
+            return 'none'
+        poor = posture.is_poor_posture(angle)
+        event = self.timer.update(poor, timestamp)
+        if event is not None:
+            self.events.append([self.file, frame_index, timestamp, event, angle])
+        return 'poor' if poor else 'good'
+
+
+def analyse_video(path):
+    capture = cv2.VideoCapture(path)
+    fps = capture.get(cv2.CAP_PROP_FPS) or 10.0
+    file = os.path.basename(path)
+    events = PostureEvents(file)
+    rows = []
+    frame_index = 0
+    start = time.perf_counter()
+    finished = False
+    while not finished:
+        frames = []
+        while len(frames) < _batch_size:
+            ok, frame = capture.read()
+            if not ok:
+                finished = True
+                break
+            frames.append(frame)
+        if not frames:
+            break
+        if len(frames) == 1:
+            batch_detections = [posture.detect(frames[0], _model)]
+        else:
+            batch_detections = posture.detect_batch(frames, _model)
+        for detections in batch_detections:
+            ear, nose, angle = posture.measure(*detections[:3])
+            timestamp = frame_index / fps
+            verdict = events.update(frame_index, timestamp, angle)
+            rows.append([file, frame_index, round(timestamp, 3),
+                         ear[0] if ear else '', ear[1] if ear else '',
+                         nose[0] if nose else '', nose[1] if nose else '',
+                         round(angle, 2) if angle is not None else '', verdict])
+            frame_index += 1
+    capture.release()
+    return path, rows, events.events, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless posture analysis of recorded videos")
+    parser.add_argument('paths', nargs='+', help="video files or directories of recordings")
+    parser.add_argument('--workers', type=int, default=max(1, multiprocessing.cpu_count() // 2),
+                        help="worker processes, each loads its own network (default: half the cores)")
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help="frames per forward pass, see benchmarks/batch_inference.py (default: 1)")
+    parser.add_argument('--output', default='analysis.csv', help="per-frame angles (default: analysis.csv)")
+    parser.add_argument('--events', default=None,
+                        help="posture events (default: the output name with _events appended)")
+    args = parser.parse_args()
+
+    videos = find_videos(args.paths)
+    if not videos:
+        print("No videos found")
+        return
+    events_file = args.events or os.path.splitext(args.output)[0] + '_events.csv'
+    workers = max(1, min(args.workers, len(videos)))
+    cv_threads = max(1, multiprocessing.cpu_count() // workers)
+    print("Analysing %d videos with %d workers" % (len(videos), workers))
+
+    total_frames = 0
+    start = time.perf_counter()
+    with open(args.output, 'w', newline='') as frames_out, open(events_file, 'w', newline='') as events_out, \
+            multiprocessing.Pool(workers, initializer=init_worker,
+                                 initargs=(cv_threads, max(1, args.batch_size))) as pool:
+        frame_writer = csv.writer(frames_out)
+        frame_writer.writerow(FRAME_FIELDS)
+        event_writer = csv.writer(events_out)
+        event_writer.writerow(EVENT_FIELDS)
+        for path, rows, events, seconds in pool.imap_unordered(analyse_video, videos):
+            frame_writer.writerows(rows)
+            event_writer.writerows(events)
+            total_frames += len(rows)
+            print("%s: %d frames, %d events, %.1f frames/sec" % (
+                path, len(rows), len(events), len(rows) / max(seconds, 1e-6)))
+    elapsed = time.perf_counter() - start
+    print("Total: %d frames in %.1f s, %.1f frames/sec" % (total_frames, elapsed, total_frames / max(elapsed, 1e-6)))
+    print("Wrote %s and %s" % (args.output, events_file))
+
+
+if __name__ == '__main__':
+    main()
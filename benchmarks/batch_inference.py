@@ -0,0 +1,39 @@
+# Frames/sec of YoloModel.forward_batch plus decode for several batch sizes on the CPU
+#
+# Usage (from the repository root):  python -m benchmarks.batch_inference [batch sizes...]
+import sys
+import time
+
+import numpy as np
+import yaml
+from munch import munchify
+
+import posture
+from yolo_model import YoloModel
+
+FRAME_SIZE = 1920, 1080
+ROUNDS = 5
+
+
+def main(batch_sizes=(1, 2, 4, 8)):
+    settings = munchify(yaml.safe_load(open("config/config.yml")))
+    model = YoloModel.from_settings(settings)
+    rng = np.random.default_rng(0)
+    frames = [rng.integers(0, 255, (FRAME_SIZE[1], FRAME_SIZE[0], 3), dtype=np.uint8) for _ in range(max(batch_sizes))]
+
+    print("Backend %s, input %dx%d, frames %dx%d" % (model.backend.name, model.input_width, model.input_height,
+                                                     FRAME_SIZE[0], FRAME_SIZE[1]))
+    print("batch   frames/sec   ms/batch   ms/frame")
+    for batch_size in batch_sizes:
+        batch = frames[:batch_size]
+        posture.detect_batch(batch, model)  # Warm up, allocates the blob for this batch size
+        start = time.perf_counter()
+        for _ in range(ROUNDS):
+            posture.detect_batch(batch, model)
+        per_batch = (time.perf_counter() - start) / ROUNDS
+        print("%5d %12.1f %10.1f %10.1f" % (batch_size, batch_size / per_batch, per_batch * 1000,
+                                            per_batch * 1000 / batch_size))
+
+
+if __name__ == '__main__':
+    main([int(size) for size in sys.argv[1:]] or (1, 2, 4, 8))
@@ -0,0 +1,78 @@
+# Micro-benchmark of posture.find_objects against the old per-row loop
+#
+# Usage (from the repository root):  python -m benchmarks.find_objects [frames]
+import sys
+import time
+
+import cv2
+import numpy as np
+
+import posture
+from posture import SUPPRESSION_THRESHOLD, THRESHOLD, YOLO_IMAGE_SIZE
+
+FRAME_SIZE = 1920, 1080
+# yolov4-tiny at 416x416: 13x13 and 26x26 grids, 3 anchors each, 5 + 2 classes per row
+OUTPUT_SHAPES = (13 * 13 * 3, 7), (26 * 26 * 3, 7)
+
+
+def synthetic_outputs(rng):
+    outputs = []
+    for shape in OUTPUT_SHAPES:
+        output = rng.random(shape, dtype=np.float32)
+        output[:, 2:4] *= 0.2
+        output[:, 5:] *= 0.201  # Only a handful of rows above the 0.2 threshold, like a real frame
+        outputs.append(output)
+    return outputs
+
+
+# The decode as it was before vectorisation, kept here as the reference
+def find_objects_loop(model_outputs):
+    bounding_box_locations = []
+    class_ids = []
+    confidence_values = []
+
+    for output in model_outputs:
+        for prediction in output:
+            class_probabilities = prediction[5:]
+            class_id = np.argmax(class_probabilities)
+            confidence = class_probabilities[class_id]
+
+            if confidence > THRESHOLD:
+                w, h = int(prediction[2] * YOLO_IMAGE_SIZE), int(prediction[3] * YOLO_IMAGE_SIZE)
+                x, y = int(prediction[0] * YOLO_IMAGE_SIZE - w / 2), int(
+                    prediction[1] * YOLO_IMAGE_SIZE - h / 2)
+                bounding_box_locations.append([x, y, w, h])
+                class_ids.append(class_id)
+                confidence_values.append(float(confidence))
+
+    box_indexes_to_keep = cv2.dnn.NMSBoxes(bounding_box_locations, confidence_values, THRESHOLD,
+                                           SUPPRESSION_THRESHOLD)
+
+    return box_indexes_to_keep, bounding_box_locations, class_ids, confidence_values
+
+
+def time_per_frame(decode, frames):
+    start = time.perf_counter()
+    for model_outputs in frames:
+        decode(model_outputs)
+    return (time.perf_counter() - start) / len(frames)
+
+
+def main(n_frames=200):
+    rng = np.random.default_rng(0)
+    frames = [synthetic_outputs(rng) for _ in range(n_frames)]
+
+    kept_loop = len(find_objects_loop(frames[0])[0])
+    kept_vector = len(posture.find_objects(frames[0])[0])
+    print("Boxes kept on first frame: loop %d, vectorised %d" % (kept_loop, kept_vector))
+
+    loop = time_per_frame(find_objects_loop, frames)
+    vector = time_per_frame(lambda outputs: posture.find_objects(outputs, *FRAME_SIZE), frames)
+    print("Rows per frame: %d" % sum(shape[0] for shape in OUTPUT_SHAPES))
+    print("Loop decode:       %8.3f ms/frame" % (loop * 1000))
+    print("Vectorised decode: %8.3f ms/frame" % (vector * 1000))
+    print("Speed-up:          %8.1fx" % (loop / vector))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
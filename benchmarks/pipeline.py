@@ -0,0 +1,116 @@
+# End to end benchmark of the capture -> detection -> annotate/record pipeline, without a camera or GUI
+#
+# Every source runs for --seconds through a full Pipeline, timed once the model has loaded. The
+# recordings, event log and catalog of a run go to a temporary directory, removed afterwards, so
+# the real ones are left alone; the stage fps, latency percentiles, CPU and peak memory of each
+# run are written as JSON. A source is 'synthetic', 'synthetic@15' (fps) or a video file,
+# e.g. a clip from record_folder_poor, which is replayed at its own frame rate and looped.
+#
+# Usage (from the repository root):
+#   python -m benchmarks.pipeline --source synthetic --source record/2022-06-26__10-00-00.mp4 --seconds 30
+#   python -m benchmarks.pipeline --min-fps 5   # exit status 1 if any run annotates slower, for CI
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import yaml
+from munch import munchify
+
+from event_log import get_event_log
+from frame_source import open_source
+from pipeline import InferencePool, Pipeline, inference_pool_size
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+CAMERA_NAME = 'benchmark'
+MODEL_LOAD_SECONDS = 120
+
+
+def peak_memory_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)  # bytes on macOS, KB elsewhere
+
+
+# The config with every file a run writes moved into folder
+def benchmark_settings(folder):
+    settings = munchify(yaml.safe_load(open("config/config.yml")))
+    settings.record_folder_poor = os.path.join(folder, 'record')
+    settings.record_folder_good = os.path.join(folder, 'good')
+    settings.event_log_file = os.path.join(folder, 'events.jsonl')
+    settings.catalog_file = os.path.join(folder, 'recordings.db')
+    settings.metrics_file = ''
+    return settings
+
+
+def run(spec, img_size, seconds):
+    folder = tempfile.mkdtemp(prefix='headsup_benchmark_')
+    settings = benchmark_settings(folder)
+    try:
+        pool = InferencePool(settings, inference_pool_size(settings))
+        pool.start()
+        pipeline = Pipeline(spec, img_size, pool=pool, camera_name=CAMERA_NAME, settings=settings,
+                            source=open_source(spec, img_size, loop=True))
+        pipeline.on_frame = pipeline.get_display_frame  # Stands in for the GUI taking every frame
+        pipeline.start()
+        if not pool.wait_ready(MODEL_LOAD_SECONDS):
+            raise RuntimeError("Model did not load within %d s" % MODEL_LOAD_SECONDS)
+        # Frames dropped while the model was loading are not the pipeline's speed
+        for stats in pipeline.stats.values():
+            stats.reset()
+        pipeline.metrics()  # Starts the CPU measurement
+        time.sleep(seconds)
+        pipeline.stop()
+        pool.stop()
+        result = pipeline.metrics()
+        result['source'] = spec
+        result['seconds'] = seconds
+        result['peak_memory_mb'] = peak_memory_mb()
+        return result
+    finally:
+        get_event_log(settings).close()  # Its writer thread would recreate the file
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End to end pipeline benchmark")
+    parser.add_argument('--source', action='append',
+                        help="synthetic, synthetic@FPS or a video file, repeat for several runs (default: synthetic)")
+    parser.add_argument('--size', default='1280x720', help="synthetic frame size (default: 1280x720)")
+    parser.add_argument('--seconds', type=float, default=20, help="length of each run (default: 20)")
+    parser.add_argument('--output', default='pipeline_benchmark.json', help="results (default: pipeline_benchmark.json)")
+    parser.add_argument('--min-fps', type=float, help="fail when a run annotates fewer frames per second")
+    args = parser.parse_args()
+    img_size = tuple(int(n) for n in args.size.lower().split('x'))
+
+    results = []
+    for spec in args.source or ['synthetic']:
+        result = run(spec, img_size, args.seconds)
+        results.append(result)
+        stages = result['stages']
+        print("%-30s grab %5.1f fps  annotate %5.1f fps  forward p50 %6.1f p95 %6.1f ms  "
+              "latency p50 %6.1f ms  cpu %4.0f%%  peak %s MB" % (
+                  spec, stages['grab']['fps'], stages['annotate']['fps'], stages['forward']['p50_ms'],
+                  stages['forward']['p95_ms'], stages['display']['p50_ms'], result['cpu_percent'],
+                  result['peak_memory_mb']))
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print("Wrote %s" % args.output)
+
+    if args.min_fps is not None:
+        slow = [result['source'] for result in results if result['stages']['annotate']['fps'] < args.min_fps]
+        if slow:
+            print("Below %.1f fps: %s" % (args.min_fps, ', '.join(slow)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+import os
+
+import cv2
+import numpy as np
+
+
+def sidecar_paths(video_path):
+    base = os.path.splitext(video_path)[0]
+    return base + '.angles.npy', base + '.thumbs.npy'
+
+
+class ClipIndex:
+    """Sidecar of a clip: the angle of every frame (NaN where the head was not found) and
+    every Nth frame as a small thumbnail, so a player can draw the angle timeline and show
+    previews without decoding the video. Loaded memory mapped, only what is drawn is read.
+    """
+
+    def __init__(self, thumbnail_every=10, thumbnail_width=160):
+        self.thumbnail_every = thumbnail_every
+        self.thumbnail_width = thumbnail_width
+        self.angles = []
+        self.thumbnails = []
+
+    def add(self, frame, angle):
+        if len(self.angles) % self.thumbnail_every == 0:
+            height = max(1, frame.shape[0] * self.thumbnail_width // frame.shape[1])
+            self.thumbnails.append(cv2.resize(frame, (self.thumbnail_width, height), interpolation=cv2.INTER_AREA))
+        self.angles.append(np.nan if angle is None else angle)
+
+    def save(self, video_path):
+        if not self.angles:
+            return
+        angles_path, thumbs_path = sidecar_paths(video_path)
+        np.save(angles_path, np.asarray(self.angles, dtype=np.float32))
+        np.save(thumbs_path, np.stack(self.thumbnails))
+
+    @staticmethod
+    def load(video_path):
+        """(angles, thumbnails) arrays of a clip, or None when it has no sidecar."""
+        angles_path, thumbs_path = sidecar_paths(video_path)
+        try:
+            return np.load(angles_path, mmap_mode='r'), np.load(thumbs_path, mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def remove(video_path):
+        for path in sidecar_paths(video_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+# Thumbnails are evenly spaced, so a fraction of the clip picks the nearest one
+def thumbnail_at(thumbnails, fraction):
+    return thumbnails[min(len(thumbnails) - 1, max(0, int(fraction * len(thumbnails))))]
@@ -0,0 +1,159 @@
+# Accuracy against speed of a faster model (FP16, INT8) compared with the FP32 reference
+#
+# Runs every model over the same frames of recorded clips and reports the per-frame latency of
+# each next to how often the candidate agrees with the reference: ear and nose found or not,
+# their centres in pixels, the posture angle and the good/poor verdict. A model is a backend
+# name, with the ONNX file after a colon for onnxruntime.
+#
+# Usage (from the repository root):
+#   python compare_models.py record good --candidate onnxruntime:config/yolov4-tiny_best-5.int8.onnx
+#   python compare_models.py record --candidate opencv_fp16 --every 5 --output comparison.csv
+import argparse
+import csv
+import math
+import time
+
+import cv2
+import numpy as np
+import yaml
+from munch import munchify
+
+from batch_analysis import find_videos
+import posture
+from yolo_model import YoloModel
+
+FRAME_FIELDS = ['file', 'frame', 'model', 'ms', 'ear_x', 'ear_y', 'nose_x', 'nose_y', 'angle']
+
+
+def load_model(spec, settings):
+    backend, _, onnx_file = spec.partition(':')
+    return YoloModel(settings.get('model_weights'), settings.get('model_cfg'), backend,
+                     onnx_file or settings.get('model_onnx'), settings.get('inference_input_size'))
+
+
+def distance(a, b):
+    return math.hypot(a[0] - b[0], a[1] - b[1])
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else float('nan')
+
+
+class Agreement:
+    """Running totals of one candidate against the reference."""
+
+    def __init__(self, name):
+        self.name = name
+        self.milliseconds = []
+        self.ear_agree = 0
+        self.nose_agree = 0
+        self.offsets = []  # Pixels between the reference and candidate ear and nose centres
+        self.angle_errors = []
+        self.posture_agree = 0
+        self.posture_frames = 0
+        self.frames = 0
+
+    def add(self, reference, candidate, milliseconds):
+        self.frames += 1
+        self.milliseconds.append(milliseconds)
+        (ref_ear, ref_nose, ref_angle), (ear, nose, angle) = reference, candidate
+        self.ear_agree += (ref_ear is None) == (ear is None)
+        self.nose_agree += (ref_nose is None) == (nose is None)
+        self.offsets += [distance(a, b) for a, b in ((ref_ear, ear), (ref_nose, nose))
+                         if a is not None and b is not None]
+        if ref_angle is not None and angle is not None:
+            self.angle_errors.append(abs(angle - ref_angle))
+            self.posture_frames += 1
+            self.posture_agree += posture.is_poor_posture(angle) == posture.is_poor_posture(ref_angle)
+
+    def summary(self, reference_ms):
+        frames = max(1, self.frames)
+        return {'model': self.name, 'frames': self.frames,
+                'p50_ms': round(percentile(self.milliseconds, 50), 2),
+                'p95_ms': round(percentile(self.milliseconds, 95), 2),
+                'speedup': round(percentile(reference_ms, 50) / max(percentile(self.milliseconds, 50), 1e-6), 2),
+                'ear_agree_pct': round(100 * self.ear_agree / frames, 1),
+                'nose_agree_pct': round(100 * self.nose_agree / frames, 1),
+                'offset_p95_px': round(percentile(self.offsets, 95), 1),
+                'angle_mean_err': round(float(np.mean(self.angle_errors)), 2) if self.angle_errors else float('nan'),
+                'angle_p95_err': round(percentile(self.angle_errors, 95), 2),
+                'posture_agree_pct': round(100 * self.posture_agree / self.posture_frames, 1)
+                if self.posture_frames else float('nan')}
+
+
+# Ear and nose centres, angle and milliseconds of forward pass plus decode for one frame
+def run_model(model, frame):
+    start = time.perf_counter()
+    detections = posture.detect(frame, model)
+    milliseconds = (time.perf_counter() - start) * 1000
+    return posture.measure(*detections[:3]), milliseconds
+
+
+def main():
+    settings = munchify(yaml.safe_load(open("config/config.yml")))
+    parser = argparse.ArgumentParser(description="Compare a faster model against the reference on recordings")
+    parser.add_argument('paths', nargs='+', help="video files or directories of recordings")
+    parser.add_argument('--reference', default='opencv', help="reference model (default: opencv, FP32 darknet)")
+    parser.add_argument('--candidate', action='append', required=True,
+                        help="model to compare, e.g. opencv_fp16 or onnxruntime:model.int8.onnx; repeatable")
+    parser.add_argument('--every', type=int, default=1, help="compare every Nth frame (default: 1)")
+    parser.add_argument('--output', help="per-frame results of every model as CSV")
+    args = parser.parse_args()
+
+    videos = find_videos(args.paths)
+    if not videos:
+        print("No videos found")
+        return
+    reference = load_model(args.reference, settings)
+    candidates = [(spec, load_model(spec, settings)) for spec in args.candidate]
+    agreements = [Agreement(spec) for spec, model in candidates]
+    reference_ms = []
+
+    writer = None
+    output = open(args.output, 'w', newline='') if args.output else None
+    if output is not None:
+        writer = csv.writer(output)
+        writer.writerow(FRAME_FIELDS)
+    warmed = False
+    for path in videos:
+        capture = cv2.VideoCapture(path)
+        frame_index = -1
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            frame_index += 1
+            if frame_index % args.every:
+                continue
+            if not warmed:  # The first pass of each model includes one-off initialisation, keep it out of the timings
+                for model in [reference] + [model for spec, model in candidates]:
+                    run_model(model, frame)
+                warmed = True
+            results = [(args.reference,) + run_model(reference, frame)]
+            results += [(spec,) + run_model(model, frame) for spec, model in candidates]
+            reference_ms.append(results[0][2])
+            for agreement, (spec, measured, milliseconds) in zip(agreements, results[1:]):
+                agreement.add(results[0][1], measured, milliseconds)
+            if writer is not None:
+                for spec, (ear, nose, angle), milliseconds in results:
+                    writer.writerow([path, frame_index, spec, round(milliseconds, 2),
+                                     ear[0] if ear else '', ear[1] if ear else '',
+                                     nose[0] if nose else '', nose[1] if nose else '',
+                                     round(angle, 2) if angle is not None else ''])
+        capture.release()
+    if output is not None:
+        output.close()
+        print("Wrote %s" % args.output)
+
+    print("%-40s %8.1f ms p50 %8.1f ms p95  (reference)" % (
+        args.reference, percentile(reference_ms, 50), percentile(reference_ms, 95)))
+    for agreement in agreements:
+        s = agreement.summary(reference_ms)
+        print("%-40s %8.1f ms p50 %8.1f ms p95  %4.2fx  ear %5.1f%%  nose %5.1f%%  offset p95 %5.1f px  "
+              "angle err %5.2f (p95 %5.2f)  posture %5.1f%%" % (
+                  s['model'], s['p50_ms'], s['p95_ms'], s['speedup'], s['ear_agree_pct'], s['nose_agree_pct'],
+                  s['offset_p95_px'], s['angle_mean_err'], s['angle_p95_err'], s['posture_agree_pct']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+# Structured posture event log, one JSON object per line
+#
+# Query it from the repository root, e.g. the alarms of the last hour:
+#   python event_log.py events.jsonl --event alarm --since 3600
+import argparse
+import atexit
+import collections
+import glob
+import json
+import os
+import threading
+import time
+
+
+class EventLog:
+    """log() only appends the event to an in-memory queue, so it costs next to nothing on the
+    frame threads; a background thread writes the queue out in batches every flush_seconds.
+
+    Once the file grows past max_bytes it is rotated to path.1 (path.2 ... up to backups),
+    the same scheme as logging.handlers.RotatingFileHandler.
+    """
+
+    def __init__(self, path='events.jsonl', max_bytes=1000000, backups=3, flush_seconds=1.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_seconds = flush_seconds
+        self.written = 0
+        self._pending = collections.deque()  # append and popleft are thread safe, log() takes no lock
+        self._cond = threading.Condition()
+        self._flushed = 0
+        self._requested = 0
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name='event-log', daemon=True)
+        self._thread.start()
+
+    def log(self, event, **fields):
+        record = {'time': round(time.time(), 3), 'event': event}
+        record.update(fields)
+        self._pending.append(record)
+
+    # Block until everything logged so far is on disk
+    def flush(self, timeout=5.0):
+        with self._cond:
+            self._requested += 1
+            request = self._requested
+            self._cond.notify_all()
+            self._cond.wait_for(lambda: self._flushed >= request or not self._thread.is_alive(), timeout)
+
+    def close(self):
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        self._thread.join(5.0)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._stop:
+                    self._cond.wait(self.flush_seconds)
+                request, stop = self._requested, self._stop
+            try:
+                self._write()
+            except OSError as e:
+                print("Error: event log %s - %s." % (e.filename, e.strerror))
+            with self._cond:
+                self._flushed = request
+                self._cond.notify_all()
+            if stop:
+                break
+
+    def _write(self):
+        if not self._pending:
+            return
+        lines = []
+        while self._pending:
+            lines.append(json.dumps(self._pending.popleft()) + '\n')
+        with open(self.path, 'a') as f:
+            f.writelines(lines)
+            size = f.tell()
+        self.written += len(lines)
+        if size > self.max_bytes:
+            rotate(self.path, self.backups)
+
+
+def rotate(path, backups):
+    """Move path to path.1, path.1 to path.2 ... keeping backups old files."""
+    for i in range(backups - 1, 0, -1):
+        if os.path.exists('%s.%d' % (path, i)):
+            os.replace('%s.%d' % (path, i), '%s.%d' % (path, i + 1))
+    if backups > 0:
+        os.replace(path, path + '.1')
+    else:
+        os.remove(path)
+
+
+_logs_lock = threading.Lock()
+_logs = {}
+
+
+def get_event_log(settings):
+    """The EventLog of the configured file, shared by every camera writing to it."""
+    path = settings.get('event_log_file', 'events.jsonl')
+    with _logs_lock:
+        if path not in _logs:
+            _logs[path] = EventLog(path, settings.get('event_log_max_bytes', 1000000),
+                                   settings.get('event_log_backups', 3))
+            atexit.register(_logs[path].close)
+        return _logs[path]
+
+
+def log_files(path):
+    """path and its rotated backups, oldest first."""
+    backups = [(int(name.rsplit('.', 1)[1]), name) for name in glob.glob(glob.escape(path) + '.*')
+               if name.rsplit('.', 1)[1].isdigit()]
+    files = [name for _, name in sorted(backups, reverse=True)]
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+
+def read_events(path, event=None, since=None, camera=None):
+    """Yield the logged events oldest first, optionally only one type, camera or those after since."""
+    for name in log_files(path):
+        if since is not None and os.path.getmtime(name) < since:
+            continue  # Nothing in it was written after since
+        with open(name) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # A line cut short by a crash
+                if since is not None and record.get('time', 0) < since:
+                    continue
+                if event is not None and record.get('event') != event:
+                    continue
+                if camera is not None and record.get('camera') != camera:
+                    continue
+                yield record
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the posture event log")
+    parser.add_argument('path', nargs='?', default='events.jsonl', help="event log (default: events.jsonl)")
+    parser.add_argument('--event', help="only this event type, e.g. alarm or poor_start")
+    parser.add_argument('--camera', help="only events of this camera, e.g. camera1")
+    parser.add_argument('--since', type=float, help="only the last SINCE seconds")
+    parser.add_argument('--count', action='store_true', help="print the number of events of each type")
+    args = parser.parse_args()
+
+    since = time.time() - args.since if args.since is not None else None
+    events = read_events(args.path, args.event, since, args.camera)
+    if args.count:
+        counts = collections.Counter(record.get('event') for record in events)
+        for name, count in counts.most_common():
+            print("%-16s %6d" % (name, count))
+    else:
+        for record in events:
+            print(json.dumps(record))
+
+
+if __name__ == '__main__':
+    main()
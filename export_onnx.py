@@ -0,0 +1,271 @@
+# Export of the darknet model (model_cfg + model_weights) to ONNX for the onnxruntime backend
+#
+# The graph ends in the same YOLO decode cv2.dnn applies to the darknet network, so every output
+# is rows of (centre x, centre y, width, height, objectness, class scores...) relative to the
+# input, classes scored as probability * objectness. That is the layout posture.find_objects
+# reads; ONNX files from other darknet converters end in raw convolutions and will not work.
+# Batch size and input size are dynamic. After writing, the model is checked against the opencv
+# backend on a few frames and the export fails if their outputs differ.
+#
+# Needs the onnx package (pip install onnx), and onnxruntime for the check.
+# Usage (from the repository root):
+#   python export_onnx.py                       # writes model_onnx, e.g. config/yolov4-tiny_best-5.onnx
+#   python export_onnx.py --output model.onnx --check-video record/2022-06-26__10-00-00.mp4
+import argparse
+import os
+import sys
+
+import cv2
+import numpy as np
+import yaml
+from munch import munchify
+
+try:
+    import onnx
+    from onnx import TensorProto, helper, numpy_helper
+except ImportError:
+    onnx = None
+
+OPSET = 13
+IR_VERSION = 7  # Opset 13's, newer onnx packages default to versions older runtimes cannot load
+BN_EPSILON = 1e-6  # Darknet's
+LEAKY_SLOPE = 0.1
+CLASS_THRESHOLD = 0.2  # Class scores below this are zeroed, as the cv2.dnn darknet importer does
+CHECK_TOLERANCE = 1e-3
+
+
+def read_cfg(cfg_file):
+    """[(section, {option: value})] in file order, [net] first."""
+    sections = []
+    with open(cfg_file) as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            if line.startswith('['):
+                sections.append((line.strip('[]'), {}))
+            elif '=' in line:
+                key, value = line.split('=', 1)
+                sections[-1][1][key.strip()] = value.strip()
+    return sections
+
+
+def read_weights(weights_file):
+    with open(weights_file, 'rb') as f:
+        major, minor, revision = np.fromfile(f, dtype=np.int32, count=3)
+        np.fromfile(f, dtype=np.int64 if major * 10 + minor >= 2 else np.int32, count=1)  # Images seen
+        return np.fromfile(f, dtype=np.float32)
+
+
+class GraphBuilder:
+    """Darknet layers -> ONNX nodes, one layer at a time in cfg order."""
+
+    def __init__(self, weights):
+        self.weights = weights
+        self.offset = 0
+        self.nodes = []
+        self.initializers = []
+        self.count = 0
+
+    def name(self, prefix):
+        self.count += 1
+        return '%s_%d' % (prefix, self.count)
+
+    def constant(self, prefix, value, dtype=np.float32):
+        name = self.name(prefix)
+        self.initializers.append(numpy_helper.from_array(np.asarray(value, dtype=dtype), name))
+        return name
+
+    def node(self, op, inputs, **attributes):
+        output = self.name(op.lower())
+        self.nodes.append(helper.make_node(op, inputs, [output], **attributes))
+        return output
+
+    def take(self, count):
+        values = self.weights[self.offset:self.offset + count]
+        if len(values) != count:
+            raise ValueError("The weights file is shorter than the cfg needs")
+        self.offset += count
+        return values
+
+    def convolutional(self, x, channels, options):
+        filters, size = int(options['filters']), int(options['size'])
+        stride = int(options.get('stride', 1))
+        pad = size // 2 if int(options.get('pad', 0)) else int(options.get('padding', 0))
+        biases = self.take(filters)
+        if int(options.get('batch_normalize', 0)):
+            scales, mean, variance = self.take(filters), self.take(filters), self.take(filters)
+            weights = self.take(filters * channels * size * size).reshape(filters, channels, size, size)
+            # Fold the batch norm into the convolution
+            factor = scales / np.sqrt(variance + BN_EPSILON)
+            weights = weights * factor[:, None, None, None]
+            biases = biases - mean * factor
+        else:
+            weights = self.take(filters * channels * size * size).reshape(filters, channels, size, size)
+        x = self.node('Conv', [x, self.constant('w', weights), self.constant('b', biases)],
+                      kernel_shape=[size, size], strides=[stride, stride], pads=[pad] * 4)
+        activation = options.get('activation', 'linear')
+        if activation == 'leaky':
+            x = self.node('LeakyRelu', [x], alpha=LEAKY_SLOPE)
+        elif activation != 'linear':
+            raise NotImplementedError("Activation %s is not supported" % activation)
+        return x, filters
+
+    def yolo(self, x, image, options):
+        """Raw head (N, A * (5 + C), H, W) -> (N, H * W * A, 5 + C) rows, decoded as cv2.dnn does."""
+        mask = [int(value) for value in options['mask'].split(',')]
+        anchors = np.array([float(value) for value in options['anchors'].split(',')], np.float32).reshape(-1, 2)[mask]
+        classes = int(options['classes'])
+        scale_xy = float(options.get('scale_x_y', 1))
+        values = 5 + classes
+        x = self.node('Transpose', [x], perm=[0, 2, 3, 1])  # N, H, W, A * values
+        x = self.node('Reshape', [x, self.constant('shape', [0, 0, 0, len(mask), values], np.int64)])
+
+        def piece(start, end):
+            return self.node('Slice', [x, self.constant('start', [start], np.int64),
+                                       self.constant('end', [end], np.int64), self.constant('axis', [4], np.int64)])
+
+        # Grid cell indexes and sizes from the actual input, so any input size works
+        shape = self.node('Cast', [self.node('Shape', [x])], to=TensorProto.FLOAT)
+        rows = self.node('Gather', [shape, self.constant('index', 1, np.int64)])
+        columns = self.node('Gather', [shape, self.constant('index', 2, np.int64)])
+        image_shape = self.node('Cast', [self.node('Shape', [image])], to=TensorProto.FLOAT)
+        image_height = self.node('Gather', [image_shape, self.constant('index', 2, np.int64)])
+        image_width = self.node('Gather', [image_shape, self.constant('index', 3, np.int64)])
+        zero, one = self.constant('zero', 0.0), self.constant('one', 1.0)
+        grid_x = self.node('Reshape', [self.node('Range', [zero, columns, one]),
+                                       self.constant('shape', [1, 1, -1, 1, 1], np.int64)])
+        grid_y = self.node('Reshape', [self.node('Range', [zero, rows, one]),
+                                       self.constant('shape', [1, -1, 1, 1, 1], np.int64)])
+
+        def centre(raw, grid, cells):
+            value = self.node('Mul', [self.node('Sigmoid', [raw]), self.constant('scale', scale_xy)])
+            value = self.node('Sub', [value, self.constant('shift', (scale_xy - 1) / 2)])
+            return self.node('Div', [self.node('Add', [value, grid]), cells])
+
+        def size(raw, anchor, image_size):
+            anchor = self.constant('anchor', anchor.reshape(1, 1, 1, -1, 1))
+            return self.node('Div', [self.node('Mul', [self.node('Exp', [raw]), anchor]), image_size])
+
+        objectness = self.node('Sigmoid', [piece(4, 5)])
+        scores = self.node('Mul', [self.node('Sigmoid', [piece(5, values)]), objectness])
+        scores = self.node('Where', [self.node('Greater', [scores, self.constant('threshold', CLASS_THRESHOLD)]),
+                                     scores, self.constant('zero', 0.0)])
+        x = self.node('Concat', [centre(piece(0, 1), grid_x, columns), centre(piece(1, 2), grid_y, rows),
+                                 size(piece(2, 3), anchors[:, 0], image_width),
+                                 size(piece(3, 4), anchors[:, 1], image_height), objectness, scores], axis=4)
+        return self.node('Reshape', [x, self.constant('shape', [0, -1, values], np.int64)])
+
+
+def export(cfg_file, weights_file, output_file):
+    sections = read_cfg(cfg_file)
+    net = sections[0][1]
+    builder = GraphBuilder(read_weights(weights_file))
+    image = 'input'
+    outputs = []  # Per layer: (tensor, channels)
+    yolo_outputs = []
+    x, channels = image, int(net.get('channels', 3))
+    for kind, options in sections[1:]:
+        if kind == 'convolutional':
+            x, channels = builder.convolutional(x, channels, options)
+        elif kind == 'maxpool':
+            size, stride = int(options['size']), int(options.get('stride', 1))
+            if size != stride:
+                raise NotImplementedError("Only maxpool with size == stride is supported")
+            x = builder.node('MaxPool', [x], kernel_shape=[size, size], strides=[stride, stride])
+        elif kind == 'upsample':
+            stride = float(options.get('stride', 2))
+            x = builder.node('Resize', [x, '', builder.constant('scales', [1, 1, stride, stride])], mode='nearest',
+                             coordinate_transformation_mode='asymmetric', nearest_mode='floor')
+        elif kind == 'route':
+            layers = [int(value) for value in options['layers'].split(',')]
+            layers = [layer if layer >= 0 else len(outputs) + layer for layer in layers]
+            tensors = [outputs[layer][0] for layer in layers]
+            channels = sum(outputs[layer][1] for layer in layers)
+            x = tensors[0] if len(tensors) == 1 else builder.node('Concat', tensors, axis=1)
+            groups = int(options.get('groups', 1))
+            if groups > 1:
+                group_id = int(options.get('group_id', 0))
+                channels //= groups
+                x = builder.node('Slice', [x, builder.constant('start', [group_id * channels], np.int64),
+                                           builder.constant('end', [(group_id + 1) * channels], np.int64),
+                                           builder.constant('axis', [1], np.int64)])
+        elif kind == 'yolo':
+            yolo_outputs.append(builder.yolo(x, image, options))
+        else:
+            raise NotImplementedError("Layer [%s] is not supported" % kind)
+        outputs.append((x, channels))
+    if builder.offset != len(builder.weights):
+        print("Warning: %d weights left over, is this the cfg the weights were trained with?" % (
+            len(builder.weights) - builder.offset))
+
+    names = ['yolo_%d' % i for i in range(len(yolo_outputs))]
+    builder.nodes += [helper.make_node('Identity', [tensor], [name]) for tensor, name in zip(yolo_outputs, names)]
+    values = int(sections[-1][1]['classes']) + 5
+    graph = helper.make_graph(
+        builder.nodes, os.path.splitext(os.path.basename(weights_file))[0],
+        [helper.make_tensor_value_info(image, TensorProto.FLOAT, ['batch', 3, 'height', 'width'])],
+        [helper.make_tensor_value_info(name, TensorProto.FLOAT, ['batch', 'rows', values]) for name in names],
+        builder.initializers)
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid('', OPSET)], ir_version=IR_VERSION)
+    onnx.checker.check_model(model)
+    onnx.save(model, output_file)
+
+
+def check_frames(video, count=5):
+    frames = [np.random.default_rng(0).integers(0, 255, (1080, 1920, 3), dtype=np.uint8)]
+    if video:
+        capture = cv2.VideoCapture(video)
+        while len(frames) <= count:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            frames.append(frame)
+        capture.release()
+    return frames
+
+
+def check(cfg_file, weights_file, onnx_file, frames):
+    """Largest difference between the opencv and onnxruntime outputs over the frames."""
+    from yolo_model import YoloModel
+    reference = YoloModel(weights_file, cfg_file, 'opencv')
+    exported = YoloModel(weights_file, cfg_file, 'onnxruntime', onnx_file)
+    worst = 0.0
+    for frame in frames:
+        for expected, actual in zip(reference.forward(frame), exported.forward(frame)):
+            difference = np.abs(expected.reshape(actual.shape) - actual)
+            worst = max(worst, float(difference.max()) if np.isfinite(difference).all() else float('inf'))
+    return worst
+
+
+def main():
+    settings = munchify(yaml.safe_load(open("config/config.yml")))
+    parser = argparse.ArgumentParser(description="Export the darknet model to ONNX for the onnxruntime backend")
+    parser.add_argument('--cfg', default=settings.get('model_cfg', 'config/yolov4-tiny-5.cfg'))
+    parser.add_argument('--weights', default=settings.get('model_weights', 'config/yolov4-tiny_best-5.weights'))
+    parser.add_argument('--output', default=settings.get('model_onnx') or 'config/yolov4-tiny_best-5.onnx')
+    parser.add_argument('--check-video', help="also check on the first frames of this video")
+    parser.add_argument('--no-check', action='store_true', help="skip the check against the opencv backend")
+    args = parser.parse_args()
+
+    if onnx is None:
+        print("The onnx package is not installed: pip install onnx")
+        sys.exit(1)
+    export(args.cfg, args.weights, args.output)
+    print("Wrote %s" % args.output)
+    if args.no_check:
+        return
+    try:
+        import onnxruntime  # noqa: F401
+    except ImportError:
+        print("onnxruntime is not installed, the export was not checked against the opencv backend")
+        return
+    difference = check(args.cfg, args.weights, args.output, check_frames(args.check_video))
+    print("Largest difference from the opencv backend: %.6f" % difference)
+    if difference > CHECK_TOLERANCE:
+        print("Error: the export does not match the opencv backend, do not use it")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
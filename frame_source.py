@@ -0,0 +1,161 @@
+import time
+
+import cv2
+import numpy as np
+
+
+class CameraSource:
+    """A live camera. buffer_size frames queued in the driver (1 keeps only the newest, where the
+    driver supports it), fourcc the pixel format to ask for, e.g. 'MJPG', and fps the frame rate;
+    '' and 0 leave those to the driver."""
+
+    def __init__(self, cam_num, img_size, exposure=0, fps=0, fourcc='', buffer_size=1):
+        self.cam_num = cam_num
+        self.img_size = img_size
+        self.exposure = exposure
+        self.fps = fps
+        self.fourcc = fourcc
+        self.buffer_size = buffer_size
+        self.capture = None
+
+    def open(self):
+        self.capture = cv2.VideoCapture(self.cam_num)
+        time.sleep(0.5)  # Need this timer here for MackBookPro Camera to work
+        if self.buffer_size:
+            self.capture.set(cv2.CAP_PROP_BUFFERSIZE, self.buffer_size)
+        if self.fourcc:  # Before the size, some drivers only offer the larger sizes compressed
+            self.capture.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*self.fourcc))
+        self.capture.set(cv2.CAP_PROP_FRAME_WIDTH, self.img_size[0])
+        self.capture.set(cv2.CAP_PROP_FRAME_HEIGHT, self.img_size[1])
+        if self.exposure:
+            self.capture.set(cv2.CAP_PROP_AUTO_EXPOSURE, 0)
+            self.capture.set(cv2.CAP_PROP_EXPOSURE, self.exposure)
+        else:
+            self.capture.set(cv2.CAP_PROP_AUTO_EXPOSURE, 1)
+        if self.fps:
+            self.capture.set(cv2.CAP_PROP_FPS, self.fps)
+        if self.capture.isOpened():
+            fourcc = int(self.capture.get(cv2.CAP_PROP_FOURCC))
+            print("Camera %s: %dx%d %s %.0f fps, buffer %d" % (
+                self.cam_num, *self.frame_size(), ''.join(chr((fourcc >> 8 * i) & 0xFF) for i in range(4)).strip(),
+                self.capture.get(cv2.CAP_PROP_FPS), self.capture.get(cv2.CAP_PROP_BUFFERSIZE)))
+        return self.capture.isOpened()
+
+    def frame_size(self):
+        return (int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH) + 0.5),
+                int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT) + 0.5))
+
+    def read(self):
+        """(ok, image, captured_at): ok is False once no more frames will come, image may be None
+        for a bad frame. captured_at is the time.monotonic() the frame was taken, before decoding."""
+        if not self.capture.grab():
+            print("Error: can't grab camera image")
+            return False, None, None
+        captured_at = time.monotonic()
+        retval, image = self.capture.retrieve(0)
+        return True, image, captured_at
+
+    def release(self):
+        if self.capture is not None:
+            self.capture.release()
+
+
+class PacedSource:
+    """Delivers frames at fps as a camera would, sleeping until each frame is due."""
+
+    def __init__(self, fps):
+        self.fps = fps
+        self._next_frame = None
+
+    def _pace(self):
+        now = time.monotonic()
+        if self._next_frame is None or now - self._next_frame > 1.0:
+            self._next_frame = now  # First frame, or we fell far behind: do not try to catch up
+        elif self._next_frame > now:
+            time.sleep(self._next_frame - now)
+        self._next_frame += 1.0 / self.fps
+
+
+class FileSource(PacedSource):
+    """Replays a video file, e.g. a recorded clip, at its own frame rate (or fps), optionally looping."""
+
+    def __init__(self, path, fps=None, loop=False, realtime=True):
+        super(FileSource, self).__init__(fps)
+        self.path = path
+        self.loop = loop
+        self.realtime = realtime  # False reads as fast as the pipeline takes them
+        self.capture = None
+
+    def open(self):
+        self.capture = cv2.VideoCapture(self.path)
+        if not self.fps:
+            self.fps = self.capture.get(cv2.CAP_PROP_FPS) or 30.0
+        return self.capture.isOpened()
+
+    def frame_size(self):
+        return (int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+
+    def read(self):
+        if self.realtime:
+            self._pace()
+        captured_at = time.monotonic()
+        ok, image = self.capture.read()
+        if not ok and self.loop:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ok, image = self.capture.read()
+        if not ok:
+            print("End of %s" % self.path)
+        return ok, image, captured_at
+
+    def release(self):
+        if self.capture is not None:
+            self.capture.release()
+
+
+class SyntheticSource(PacedSource):
+    """Generated frames at a fixed rate: a moving disc and the frame number on a gradient,
+    for measuring throughput where there is no camera. frames limits the run, None is endless."""
+
+    def __init__(self, img_size=(1280, 720), fps=30.0, frames=None):
+        super(SyntheticSource, self).__init__(fps)
+        self.img_size = img_size
+        self.frames = frames
+        self.count = 0
+        self._background = None
+
+    def open(self):
+        width, height = self.img_size
+        gradient = np.linspace(40, 200, width, dtype=np.uint8)
+        self._background = np.repeat(np.tile(gradient, (height, 1))[:, :, None], 3, axis=2)
+        return True
+
+    def frame_size(self):
+        return self.img_size
+
+    def read(self):
+        if self.frames is not None and self.count >= self.frames:
+            return False, None, None
+        self._pace()
+        captured_at = time.monotonic()
+        width, height = self.img_size
+        image = self._background.copy()
+        angle = self.count / self.fps
+        centre = (int(width / 2 + width / 4 * np.cos(angle)), int(height / 2 + height / 4 * np.sin(angle)))
+        cv2.circle(image, centre, height // 8, (60, 60, 230), -1)
+        cv2.putText(image, str(self.count), (20, height - 20), cv2.FONT_HERSHEY_PLAIN, 3, (255, 255, 255), 3)
+        self.count += 1
+        return True, image, captured_at
+
+    def release(self):
+        pass
+
+
+def open_source(spec, img_size, exposure=0, fps=0, fourcc='', buffer_size=1, loop=False):
+    """Frame source for a camera number, a video file path, or 'synthetic' ('synthetic@15' for 15 fps).
+    fps, fourcc and buffer_size only apply to cameras, loop to video files."""
+    if isinstance(spec, str) and spec.startswith('synthetic'):
+        fps = float(spec.split('@', 1)[1]) if '@' in spec else 30.0
+        return SyntheticSource(img_size, fps)
+    if isinstance(spec, str) and not spec.isdigit():
+        return FileSource(spec, loop=loop)
+    return CameraSource(int(spec), img_size, exposure, fps, fourcc, buffer_size)
@@ -0,0 +1,141 @@
+import collections
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+class OpenCVBackend:
+    """cv2.dnn on the darknet weights, run on the CPU."""
+    name = 'opencv'
+    DNN_BACKEND = cv2.dnn.DNN_BACKEND_OPENCV
+    DNN_TARGET = cv2.dnn.DNN_TARGET_CPU
+
+    def __init__(self, weights_file, cfg_file, onnx_file=None):
+        self.neural_network = cv2.dnn.readNet(weights_file, cfg_file)
+        self.neural_network.setPreferableBackend(self.DNN_BACKEND)
+        self.neural_network.setPreferableTarget(self.DNN_TARGET)
+
+        # YOLO output layers - note: these indexes are starting with 1
+        layer_names = self.neural_network.getLayerNames()
+        self.output_names = [layer_names[int(index) - 1]
+                             for index in np.asarray(self.neural_network.getUnconnectedOutLayers()).reshape(-1)]
+
+    @classmethod
+    def available(cls, weights_file, cfg_file, onnx_file=None):
+        return os.path.isfile(weights_file) and os.path.isfile(cfg_file)
+
+    def run(self, blob):
+        self.neural_network.setInput(blob)
+        return self.neural_network.forward(self.output_names)
+
+
+class OpenVINOBackend(OpenCVBackend):
+    """cv2.dnn with the Inference Engine (OpenVINO) backend, only in OpenCV builds that include it."""
+    name = 'openvino'
+    DNN_BACKEND = cv2.dnn.DNN_BACKEND_INFERENCE_ENGINE
+
+    @classmethod
+    def available(cls, weights_file, cfg_file, onnx_file=None):
+        try:
+            targets = cv2.dnn.getAvailableTargets(cls.DNN_BACKEND)
+        except (cv2.error, AttributeError):
+            return False
+        return cv2.dnn.DNN_TARGET_CPU in targets and super().available(weights_file, cfg_file)
+
+
+class OpenCVFP16Backend(OpenCVBackend):
+    """cv2.dnn on the darknet weights in half precision, on CPUs with FP16 arithmetic
+    (ARMv8.2 and later, e.g. Apple silicon) and OpenCV 4.8 or later."""
+    name = 'opencv_fp16'
+    DNN_TARGET = getattr(cv2.dnn, 'DNN_TARGET_CPU_FP16', None)
+
+    @classmethod
+    def available(cls, weights_file, cfg_file, onnx_file=None):
+        if cls.DNN_TARGET is None:
+            return False
+        try:
+            targets = cv2.dnn.getAvailableTargets(cls.DNN_BACKEND)
+        except (cv2.error, AttributeError):
+            return False
+        return cls.DNN_TARGET in targets and super().available(weights_file, cfg_file)
+
+
+class OnnxRuntimeBackend:
+    """ONNX Runtime on the CPU, on a model written by export_onnx.py: its outputs are the decoded
+    YOLO rows (x, y, w, h, objectness, class scores...) cv2.dnn gives for the darknet network.
+    ONNX files from other darknet converters end before the decode and give wrong boxes.
+    Runs the INT8 model written by quantize_model.py the same way."""
+    name = 'onnxruntime'
+
+    def __init__(self, weights_file, cfg_file, onnx_file=None):
+        self.session = onnxruntime.InferenceSession(onnx_file, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    @classmethod
+    def available(cls, weights_file, cfg_file, onnx_file=None):
+        return onnxruntime is not None and bool(onnx_file) and os.path.isfile(onnx_file)
+
+    def run(self, blob):
+        return self.session.run(None, {self.input_name: blob})
+
+
+BACKENDS = collections.OrderedDict((backend.name, backend)
+                                   for backend in (OpenCVBackend, OpenVINOBackend, OpenCVFP16Backend,
+                                                   OnnxRuntimeBackend))
+
+_probe_lock = threading.Lock()
+_probe_results = {}
+
+
+def available_backends(weights_file, cfg_file, onnx_file=None):
+    return [name for name, backend in BACKENDS.items() if backend.available(weights_file, cfg_file, onnx_file)]
+
+
+def create_backend(name, weights_file, cfg_file, onnx_file=None):
+    if name not in BACKENDS:
+        raise ValueError("Unknown inference backend '%s', expected one of %s" % (name, ', '.join(BACKENDS)))
+    if not BACKENDS[name].available(weights_file, cfg_file, onnx_file):
+        raise RuntimeError("Inference backend '%s' is not available here" % name)
+    return BACKENDS[name](weights_file, cfg_file, onnx_file)
+
+
+def probe_backends(weights_file, cfg_file, onnx_file, input_size, frames=5):
+    """Time every available backend on a few synthetic frames, return {name: seconds per frame}."""
+    blob = np.random.default_rng(0).random((1, 3, input_size[1], input_size[0]), dtype=np.float32)
+    timings = collections.OrderedDict()
+    for name in available_backends(weights_file, cfg_file, onnx_file):
+        try:
+            backend = create_backend(name, weights_file, cfg_file, onnx_file)
+            backend.run(blob)  # Warm up, the first pass includes one-off initialisation
+            start = time.perf_counter()
+            for _ in range(frames):
+                backend.run(blob)
+            timings[name] = (time.perf_counter() - start) / frames
+        except Exception as e:
+            print("Inference backend %s failed the probe: %s" % (name, e))
+    return timings
+
+
+def resolve_backend(name, weights_file, cfg_file, onnx_file, input_size, frames=5):
+    """Return name, or for 'auto' the fastest backend; the probe runs once per model."""
+    if name != 'auto':
+        return name
+    key = (weights_file, cfg_file, onnx_file)
+    with _probe_lock:
+        if key not in _probe_results:
+            timings = probe_backends(weights_file, cfg_file, onnx_file, input_size, frames)
+            if not timings:
+                raise RuntimeError("No inference backend is available for %s" % weights_file)
+            fastest = min(timings, key=timings.get)
+            print("Inference backend probe: %s -> using %s" % (
+                ', '.join('%s %.1f ms' % (n, t * 1000) for n, t in timings.items()), fastest))
+            _probe_results[key] = fastest
+        return _probe_results[key]
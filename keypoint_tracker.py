@@ -0,0 +1,98 @@
+import cv2
+import numpy as np
+
+from posture import EAR_CLASSES, NOSE_CLASSES
+
+
+class BoxTracker:
+    """Constant velocity Kalman filter on the centre of one box, with its size smoothed."""
+
+    def __init__(self, position_noise=1.0, velocity_noise=10.0, measurement_noise=16.0, size_smoothing=0.3):
+        self.kalman = cv2.KalmanFilter(4, 2)  # state x, y, vx, vy (pixels, pixels per second)
+        self.kalman.measurementMatrix = np.array([[1, 0, 0, 0], [0, 1, 0, 0]], np.float32)
+        self.kalman.processNoiseCov = np.diag([position_noise, position_noise,
+                                               velocity_noise, velocity_noise]).astype(np.float32)
+        self.kalman.measurementNoiseCov = np.eye(2, dtype=np.float32) * measurement_noise
+        self.size_smoothing = size_smoothing
+        self.size = None
+        self.confidence = 0.0
+        self.missed = 0
+        self.active = False
+        self._last_time = None
+
+    def _advance(self, timestamp):
+        dt = timestamp - self._last_time
+        self.kalman.transitionMatrix = np.array([[1, 0, dt, 0], [0, 1, 0, dt], [0, 0, 1, 0], [0, 0, 0, 1]],
+                                                np.float32)
+        self.kalman.predict()
+        self._last_time = timestamp
+
+    def predict(self, timestamp):
+        if self.active:
+            self._advance(timestamp)
+
+    def correct(self, box, confidence, timestamp):
+        x, y, w, h = box
+        centre = np.array([[x + w / 2], [y + h / 2]], np.float32)
+        if not self.active:
+            self.kalman.statePost = np.array([[centre[0, 0]], [centre[1, 0]], [0], [0]], np.float32)
+            self.kalman.errorCovPost = np.diag([16, 16, 1000, 1000]).astype(np.float32)
+            self.size = np.array([w, h], np.float32)
+            self._last_time = timestamp
+            self.active = True
+        else:
+            self._advance(timestamp)
+            self.kalman.correct(centre)
+            self.size += self.size_smoothing * (np.array([w, h], np.float32) - self.size)
+        self.confidence = confidence
+        self.missed = 0
+
+    def miss(self, timestamp, max_missed):
+        self.predict(timestamp)
+        self.missed += 1
+        if self.missed > max_missed:
+            self.active = False
+
+    def box(self):
+        cx, cy = float(self.kalman.statePost[0, 0]), float(self.kalman.statePost[1, 0])
+        w, h = self.size
+        return [int(cx - w / 2), int(cy - h / 2), int(w), int(h)]
+
+
+class HeadTracker:
+    """Follows the ear and nose between YOLO detections.
+
+    correct() takes the output of posture.find_objects, predict() stands in for it on
+    frames that were not detected; both return detections in the same format, holding at
+    most one tracked ear and one tracked nose, so show_detected_objects can draw either.
+    """
+
+    def __init__(self, max_missed=3):
+        self.max_missed = max_missed  # Detections in a row a box may be missing before its track is dropped
+        self.ear = BoxTracker()
+        self.nose = BoxTracker()
+
+    def correct(self, detections, timestamp):
+        box_indexes, boxes, class_ids, confidence_values = detections
+        for tracker, classes in ((self.ear, EAR_CLASSES), (self.nose, NOSE_CLASSES)):
+            matching = [index for index in box_indexes if class_ids[index] in classes]
+            if matching:
+                best = max(matching, key=lambda index: confidence_values[index])
+                tracker.correct(boxes[best], float(confidence_values[best]), timestamp)
+            else:
+                tracker.miss(timestamp, self.max_missed)
+        return self.detections()
+
+    def predict(self, timestamp):
+        self.ear.predict(timestamp)
+        self.nose.predict(timestamp)
+        return self.detections()
+
+    def detections(self):
+        boxes, class_ids, confidence_values = [], [], []
+        for tracker, class_id in ((self.ear, EAR_CLASSES[0]), (self.nose, NOSE_CLASSES[0])):
+            if tracker.active:
+                boxes.append(tracker.box())
+                class_ids.append(class_id)
+                confidence_values.append(tracker.confidence)
+        return list(range(len(boxes))), boxes, class_ids, confidence_values
@@ -1,22 +1,42 @@
-from PyQt5.QtCore import QPoint
-from PyQt5.QtGui import QPainter
+from PyQt5.QtCore import QPoint, Qt
+from PyQt5.QtGui import QColor, QFont, QPainter
 from PyQt5.QtWidgets import QWidget
 
+HUD_FONT = QFont("Courier", 9)
+
 
 class LiveWidget(QWidget):
     def __init__(self, parent=None):
         super(LiveWidget, self).__init__(parent)
         self.image = None
+        self.pixels = None
+        self.hudLines = []
 
-    def setImage(self, image):
+    # The QImage does not own its pixels, keep the array alive until the next image replaces it
+    def setImage(self, image, pixels=None):
         self.image = image
+        self.pixels = pixels
         self.setMinimumSize(image.size())
         self.update()
 
+    # Performance readout drawn over the video, an empty list hides it
+    def setHud(self, lines):
+        self.hudLines = list(lines)
+        self.update()
+
     # @Override
     def paintEvent(self, event):
         qp = QPainter()
         qp.begin(self)
         if self.image:
             qp.drawImage(QPoint(0, 0), self.image)
-        qp.end()
\ No newline at end of file
+        if self.hudLines:
+            qp.setFont(HUD_FONT)
+            metrics = qp.fontMetrics()
+            width = max(metrics.width(line) for line in self.hudLines) + 8
+            height = metrics.height() * len(self.hudLines) + 8
+            qp.fillRect(0, 0, width, height, QColor(0, 0, 0, 160))
+            qp.setPen(Qt.green)
+            for i, line in enumerate(self.hudLines):
+                qp.drawText(4, 4 + metrics.ascent() + i * metrics.height(), line)
+        qp.end()
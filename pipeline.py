@@ -0,0 +1,518 @@
+import collections
+import json
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+import yaml
+from munch import munchify
+
+from adaptive_rate import AdaptiveRateScheduler, FixedRateScheduler
+from event_log import rotate
+from frame_source import open_source
+from keypoint_tracker import HeadTracker
+from recorder import PreRollBuffer, RecorderService
+from recording_catalog import get_catalog
+from roi_selector import RoiSelector
+from retention import get_retention_manager
+from yolo_formatter import YoloVideoSelf
+from yolo_model import YoloModel, settings_input_size
+
+REPORT_SECONDS = 30  # How often the stage counters are printed
+INFER_FAILURES_REPORTED = 10  # Frames failing in a row before the pool reports the error
+PERCENTILES = (50, 95, 99)
+
+
+class StageStats:
+    """Latency and drop counters for one pipeline stage, with percentiles over the last window latencies."""
+
+    def __init__(self, name, window=300):
+        self.name = name
+        self.count = 0
+        self.dropped = 0
+        self.last_latency = 0.0
+        self.avg_latency = 0.0
+        self.max_latency = 0.0
+        self.started = time.monotonic()
+        self._recent = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, latency):
+        with self._lock:
+            self.count += 1
+            self.last_latency = latency
+            if self.count == 1:
+                self.avg_latency = latency
+            else:
+                self.avg_latency = 0.9 * self.avg_latency + 0.1 * latency
+            self.max_latency = max(self.max_latency, latency)
+            self._recent.append(latency)
+
+    def drop(self, n=1):
+        with self._lock:
+            self.dropped += n
+
+    # Start counting afresh, e.g. once the model has loaded
+    def reset(self):
+        with self._lock:
+            self.count = 0
+            self.dropped = 0
+            self.last_latency = 0.0
+            self.avg_latency = 0.0
+            self.max_latency = 0.0
+            self.started = time.monotonic()
+            self._recent.clear()
+
+    def fps(self):
+        return self.count / max(time.monotonic() - self.started, 1e-6)
+
+    # Latencies in ms at each of PERCENTILES, zeros before the first frame
+    def percentiles(self):
+        with self._lock:
+            recent = list(self._recent)
+        if not recent:
+            return [0.0] * len(PERCENTILES)
+        return [float(value) * 1000 for value in np.percentile(recent, PERCENTILES)]
+
+    def snapshot(self):
+        p50, p95, p99 = self.percentiles()
+        with self._lock:
+            return {'count': self.count, 'dropped': self.dropped, 'fps': round(self.fps(), 2),
+                    'avg_ms': round(self.avg_latency * 1000, 2), 'max_ms': round(self.max_latency * 1000, 2),
+                    'p50_ms': round(p50, 2), 'p95_ms': round(p95, 2), 'p99_ms': round(p99, 2)}
+
+    def summary(self):
+        p50, p95, p99 = self.percentiles()
+        with self._lock:
+            return "%-10s %6d frames %6d dropped %6.1f fps  p50 %6.1f  p95 %6.1f  p99 %6.1f  max %6.1f ms" % (
+                self.name, self.count, self.dropped, self.fps(), p50, p95, p99, self.max_latency * 1000)
+
+
+class LatestFrameBuffer:
+    """Bounded FIFO that discards its oldest item when full, so a slow consumer
+    always receives the newest frames instead of a growing backlog.
+
+    Buffers given the same cond wake whoever waits on it, e.g. an InferencePool
+    serving the capture buffers of several cameras."""
+
+    def __init__(self, capacity=1, stats=None, cond=None):
+        self._items = collections.deque(maxlen=capacity)
+        self._cond = cond if cond is not None else threading.Condition()
+        self._closed = False
+        self.stats = stats  # Stats of the consuming stage, charged for every dropped frame
+
+    def put(self, item):
+        with self._cond:
+            if len(self._items) == self._items.maxlen and self.stats is not None:
+                self.stats.drop()
+            self._items.append(item)
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """Return the oldest buffered item, or None on timeout or once closed."""
+        with self._cond:
+            if timeout is None:
+                while not self._items and not self._closed:
+                    self._cond.wait()
+            elif timeout > 0 and not self._items and not self._closed:
+                self._cond.wait(timeout)
+            if self._items:
+                return self._items.popleft()
+            return None
+
+    def qsize(self):
+        with self._cond:
+            return len(self._items)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class DisplayScaler:
+    """Downscales annotated frames for the Live tab off the GUI thread, into a small pool of
+    buffers that are reused round robin instead of allocating a new image every frame."""
+
+    def __init__(self, scale=1, pool_size=3):
+        self.scale = scale
+        self.pool_size = pool_size  # A buffer is only overwritten once pool_size - 1 newer frames exist
+        self._pool = []
+        self._next = 0
+
+    def scale_frame(self, image):
+        if self.scale <= 1:
+            return image
+        height, width = image.shape[0] // self.scale, image.shape[1] // self.scale
+        if not self._pool or self._pool[0].shape[:2] != (height, width):
+            self._pool = [np.empty((height, width, 3), dtype=np.uint8) for _ in range(self.pool_size)]
+        buffer = self._pool[self._next]
+        self._next = (self._next + 1) % self.pool_size
+        cv2.resize(image, (width, height), dst=buffer, interpolation=cv2.INTER_LINEAR)
+        return buffer
+
+
+class FramePacket:
+    """A captured frame travelling through the pipeline."""
+
+    def __init__(self, seq, image, captured_at=None):
+        self.seq = seq  # Numbers every frame the source delivered, gaps are frames dropped on the way
+        self.image = image
+        self.captured_at = captured_at if captured_at is not None else time.monotonic()
+        # The same moment on the wall clock, for the posture timers and the recordings
+        self.timestamp = time.time() - (time.monotonic() - self.captured_at)
+        self.detections = None
+        self.held = False  # True when the frame was not detected and reuses earlier detections
+        self.display_image = None
+
+
+# Runs on the recorder thread, one JSON object per line, rotated like the event log past max_bytes
+def write_metrics(path, metrics, max_bytes, backups):
+    with open(path, 'a') as f:
+        f.write(json.dumps(metrics) + '\n')
+        size = f.tell()
+    if size > max_bytes:
+        rotate(path, backups)
+
+
+def inference_pool_size(settings, cameras=1):
+    """inference_workers from the config, or when it is 0 one worker per camera up to half the cores."""
+    workers = settings.get('inference_workers', 0)
+    if workers:
+        return workers
+    return max(1, min(cameras, (os.cpu_count() or 2) // 2))
+
+
+class InferencePool:
+    """Fixed set of inference threads shared by the pipelines of one or more cameras.
+
+    cv2.dnn networks are not thread safe, so every worker owns one. A free worker takes
+    the next waiting frame round robin across the cameras, so one busy camera cannot
+    starve the others, and the number of networks does not grow with the cameras.
+
+    Each worker loads and warms its network once, on its own thread, so a pool that
+    outlives its pipelines lets cameras be switched without reloading the model.
+    """
+
+    def __init__(self, settings, workers=1):
+        self.settings = settings
+        self.workers = max(1, workers)
+        self.cond = threading.Condition()  # Shared by the capture buffers of every pipeline
+        self.loaded = 0  # Workers with a warm network
+        self.error = None  # Why a worker could not load its network, or why inference keeps failing
+        self.ready = threading.Event()  # Set once every worker has loaded its network or failed to
+        self._pipelines = []
+        self._next = 0
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        self._threads = [threading.Thread(target=self._worker, name='inference-%d' % i, daemon=True)
+                         for i in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=2.0):
+        self._stop.set()
+        with self.cond:
+            self.cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    # True once every worker has a warm network, False if still loading after timeout seconds;
+    # raises RuntimeError if a worker failed to load
+    def wait_ready(self, timeout=60):
+        if not self.ready.wait(timeout):
+            return False
+        if self.error is not None:
+            raise RuntimeError("Inference model failed to load: %s" % self.error)
+        return True
+
+    def add(self, pipeline):
+        with self.cond:
+            if pipeline.is_running():  # Lost the race with pipeline.stop()
+                self._pipelines.append(pipeline)
+
+    def remove(self, pipeline):
+        with self.cond:
+            if pipeline in self._pipelines:
+                self._pipelines.remove(pipeline)
+
+    # Caller holds self.cond
+    def _take(self):
+        count = len(self._pipelines)
+        for i in range(count):
+            pipeline = self._pipelines[(self._next + i) % count]
+            packet = pipeline.capture_buffer.get(timeout=0)
+            if packet is not None:
+                self._next = (self._next + i + 1) % count
+                return pipeline, packet
+        return None, None
+
+    def _load_model(self):
+        start = time.monotonic()
+        model = YoloModel.from_settings(self.settings)
+        # The first forward pass allocates and tunes the backend, do it before the first real frame
+        model.forward(np.zeros((model.input_height, model.input_width, 3), dtype=np.uint8))
+        with self.cond:
+            self.loaded += 1
+            if self.loaded == self.workers:
+                self.ready.set()
+        print("Inference worker %d/%d ready in %.1f s" % (self.loaded, self.workers, time.monotonic() - start))
+        return model
+
+    def _worker(self):
+        try:
+            model = self._load_model()
+        except Exception as e:  # Missing weights, unavailable backend, bad model file...
+            print("Error: inference worker could not load the model: %s" % e)
+            self.error = e
+            self.ready.set()  # Nothing more to wait for
+            return
+        failures = 0
+        while not self._stop.is_set():
+            with self.cond:
+                pipeline, packet = self._take()
+                if packet is None:
+                    self.cond.wait(0.5)
+                    continue
+            try:
+                pipeline.infer(packet, model)
+            except Exception as e:  # Backend error, a crop the model cannot take... skip the frame
+                failures += 1
+                pipeline.stats['inference'].drop()
+                if failures == 1:
+                    print("Error: inference failed: %s" % e)
+                if failures == INFER_FAILURES_REPORTED:
+                    self.error = e
+                continue
+            if failures >= INFER_FAILURES_REPORTED:
+                self.error = None  # Recovered
+            failures = 0
+
+
+class Pipeline:
+    """Capture thread -> inference worker(s) -> annotate/record thread -> display.
+
+    Every hand-off goes through a LatestFrameBuffer, so the camera is read at
+    sensor rate while inference runs at whatever rate the CPU allows; frames the
+    slower stages cannot keep up with are dropped and counted.
+
+    Without a pool the pipeline runs its own InferencePool of inference_workers threads;
+    several cameras share one pool, each with its own pipeline, posture state and folders.
+    """
+
+    # inference is preprocess + forward + decode + nms, and with annotate carries the buffer drops;
+    # display is the whole capture to display latency
+    STAGES = ('grab', 'preprocess', 'forward', 'decode', 'nms', 'inference', 'annotate', 'encode', 'display')
+
+    def __init__(self, cam_num, img_size, exposure=0, display_scale=1, on_frame=None, pool=None, camera_name=None,
+                 source=None, settings=None):
+        self.settings = settings if settings is not None else munchify(yaml.safe_load(open("config/config.yml")))
+        self.cam_num = cam_num  # Camera number, video file or 'synthetic', see frame_source.open_source
+        self.source = source  # Or a ready made frame source
+        self.img_size = img_size
+        self.exposure = exposure
+        self.camera_name = camera_name
+        self._owns_pool = pool is None
+        self.pool = pool if pool is not None else InferencePool(self.settings, inference_pool_size(self.settings))
+        buffer_size = self.settings.get('frame_buffer_size', 1)
+        self.stats = collections.OrderedDict((name, StageStats(name)) for name in self.STAGES)
+        self.capture_buffer = LatestFrameBuffer(buffer_size, self.stats['inference'], self.pool.cond)
+        self.detection_buffer = LatestFrameBuffer(buffer_size, self.stats['annotate'])
+        # The display only ever wants the newest frame
+        self.display_buffer = LatestFrameBuffer(1, self.stats['display'])
+        self.display_scaler = DisplayScaler(display_scale)
+        self.on_frame = on_frame  # Called on the annotate thread whenever a display frame is ready
+        preroll = PreRollBuffer(self.settings.get('preroll_seconds', 8), self.settings.get('preroll_scale', 0.5),
+                                self.settings.get('preroll_jpeg_quality', 80))
+        self.recorder = RecorderService(self.settings.get('recorder_queue_frames', 30), preroll, self.stats['encode'],
+                                        get_catalog(self.settings), self.settings.get('thumbnail_every', 10),
+                                        self.settings.get('thumbnail_width', 160))
+        self.retention = get_retention_manager(self.settings)
+        self.yoloVideoSelf = YoloVideoSelf(self.recorder, camera_name=camera_name, retention=self.retention,
+                                           settings=self.settings)
+        self.retention.watch(self.yoloVideoSelf.RECORD_FOLDER_POOR, 'poor')
+        self.retention.watch(self.yoloVideoSelf.RECORD_FOLDER_GOOD, 'good')
+        self.tracker = None
+        if self.settings.get('tracking', False):
+            self.tracker = HeadTracker(self.settings.get('tracker_max_missed', 3))
+        self.scheduler = None
+        if self.settings.get('adaptive_inference', False):
+            self.scheduler = AdaptiveRateScheduler(self.yoloVideoSelf.posteriorAngle, self.yoloVideoSelf.anteriorAngle,
+                                                   self.settings.get('adaptive_max_skip', 8),
+                                                   self.settings.get('adaptive_margin', 5),
+                                                   self.settings.get('adaptive_stable_delta', 2))
+        elif self.tracker is not None and self.settings.get('tracker_detect_every', 1) > 1:
+            self.scheduler = FixedRateScheduler(self.settings.get('tracker_detect_every'))
+        self.roi = None
+        self.roi_input_size = None
+        if self.settings.get('roi_inference', False):
+            self.roi_input_size = self.settings.get('roi_input_size', 256) or None  # 0 keeps the model's size
+            self.roi = RoiSelector(self.settings.get('roi_padding', 1.0), self.settings.get('roi_full_frame_every', 30),
+                                   self.roi_input_size or max(settings_input_size(self.settings)))
+        self._last_detections = None
+        self.metrics_file = self.settings.get('metrics_file') or None
+        self.metrics_seconds = self.settings.get('metrics_seconds', 30)
+        self._cpu_marks = {}
+        self._cpu_start = (time.monotonic(), time.process_time())
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        self._threads = [threading.Thread(target=self._capture_loop, name='capture', daemon=True),
+                         threading.Thread(target=self._annotate_loop, name='annotate', daemon=True)]
+        for thread in self._threads:
+            thread.start()
+        if self._owns_pool:
+            self.pool.start()
+
+    def stop(self, timeout=2.0):
+        self._stop.set()
+        self.pool.remove(self)
+        if self._owns_pool:
+            self.pool.stop(timeout)
+        for buffer in (self.capture_buffer, self.detection_buffer, self.display_buffer):
+            buffer.close()
+        for thread in self._threads:
+            thread.join(timeout)
+        self.recorder.stop()
+
+    def is_running(self):
+        return not self._stop.is_set()
+
+    # Called from the GUI thread: newest annotated frame already scaled for display, or None if nothing new
+    def get_display_frame(self):
+        packet = self.display_buffer.get(timeout=0)
+        if packet is None:
+            return None
+        self.stats['display'].record(time.monotonic() - packet.captured_at)
+        return packet.display_image
+
+    # Process CPU use since the last call with the same reader, in % of one core
+    def cpu_percent(self, reader='report'):
+        wall, cpu = time.monotonic(), time.process_time()
+        last_wall, last_cpu = self._cpu_marks.get(reader, self._cpu_start)
+        self._cpu_marks[reader] = (wall, cpu)
+        return 100 * (cpu - last_cpu) / max(wall - last_wall, 1e-6)
+
+    def report(self):
+        lines = []
+        if self.camera_name is not None:
+            lines.append("camera     %s" % self.camera_name)
+        lines += [stats.summary() for stats in self.stats.values()]
+        if self.scheduler is not None:
+            lines.append("skipped    %6d frames went without a detection" % self.scheduler.held)
+        if self.roi is not None:
+            lines.append(self.roi.summary())
+        lines.append(self.recorder.summary())
+        lines.append(self.retention.report())
+        lines.append("cpu        %6.0f%% of one core" % self.cpu_percent())
+        return '\n'.join(lines)
+
+    # All counters as one JSON serialisable record, see metrics_file
+    def metrics(self, reader='metrics'):
+        return {'time': round(time.time(), 3), 'camera': self.camera_name or str(self.cam_num),
+                'stages': collections.OrderedDict((name, stats.snapshot()) for name, stats in self.stats.items()),
+                'skipped': self.scheduler.held if self.scheduler is not None else 0,
+                'roi': {'cropped': self.roi.cropped, 'full': self.roi.full, 'lost': self.roi.lost}
+                if self.roi is not None else None,
+                'recorder': {'written': self.recorder.written, 'dropped': self.recorder.dropped,
+                             'queued': self.recorder.queue_depth()},
+                'disk': {folder: {'clips': count, 'bytes': size}
+                         for folder, (count, size) in self.retention.usage().items()},
+                'cpu_percent': round(self.cpu_percent(reader), 1)}
+
+    # Short per stage readout for the Live view overlay
+    def hud_lines(self):
+        lines = ["%-10s %5.1f fps" % (self.camera_name or 'camera', self.stats['grab'].fps())]
+        for name in ('preprocess', 'forward', 'decode', 'nms', 'annotate', 'encode', 'display'):
+            p50, p95, p99 = self.stats[name].percentiles()
+            lines.append("%-10s %6.1f %6.1f ms" % (name, p50, p95))
+        return lines
+
+    def _capture_loop(self):
+        source = self.source if self.source is not None else open_source(
+            self.cam_num, self.img_size, self.exposure, self.settings.get('camera_fps', 0),
+            self.settings.get('camera_fourcc', ''), self.settings.get('camera_buffer_size', 1))
+        if not source.open():
+            print("Error: can't open %s" % self.cam_num)
+            self._stop.set()
+        else:
+            self.yoloVideoSelf.width, self.yoloVideoSelf.height = source.frame_size()
+            # Codec = 7634706D in HEX
+            self.yoloVideoSelf.codec = cv2.VideoWriter_fourcc(*'mp4v')  # Be sure to use the lower case
+            self.pool.add(self)  # Only now, the codec and frame size are needed to record
+
+        seq = 0
+        while not self._stop.is_set():
+            start = time.monotonic()
+            ok, image, captured_at = source.read()
+            if not ok:
+                break
+            if image is None:
+                continue
+            seq += 1
+            self.capture_buffer.put(FramePacket(seq, image, captured_at))
+            self.stats['grab'].record(time.monotonic() - start)
+        source.release()
+        self._stop.set()
+        self.capture_buffer.close()
+
+    # Called on an InferencePool worker with that worker's model
+    def infer(self, packet, model):
+        if (self.scheduler is not None and self._last_detections is not None
+                and not self.scheduler.should_detect()):
+            packet.detections = self._last_detections
+            packet.held = True
+        else:
+            timings = {}
+            start = time.monotonic()
+            region = None
+            if self.roi is not None:
+                region = self.roi.next_region(packet.image.shape[1], packet.image.shape[0])
+            packet.detections = self._last_detections = self.yoloVideoSelf.detect(
+                packet.image, model, timings, region, self.roi_input_size if region is not None else None)
+            if self.roi is not None:
+                self.roi.update(region, packet.detections)
+            self.stats['inference'].record(time.monotonic() - start)
+            for name, seconds in timings.items():
+                self.stats[name].record(seconds)
+        self.detection_buffer.put(packet)
+
+    def _annotate_loop(self):
+        last_seq = 0
+        last_report = last_metrics = time.monotonic()
+        while not self._stop.is_set():
+            packet = self.detection_buffer.get(timeout=0.5)
+            if packet is not None:
+                if packet.seq <= last_seq:  # Overtaken by a newer frame from another worker
+                    self.stats['annotate'].drop()
+                    continue
+                last_seq = packet.seq
+                start = time.monotonic()
+                detections = packet.detections
+                if self.tracker is not None:
+                    if packet.held:
+                        detections = self.tracker.predict(packet.captured_at)
+                    else:
+                        detections = self.tracker.correct(packet.detections, packet.captured_at)
+                self.yoloVideoSelf.show_detected_objects(packet.image, *detections, timestamp=packet.timestamp)
+                self.stats['annotate'].record(time.monotonic() - start)
+                if self.scheduler is not None and not packet.held:
+                    self.scheduler.update(self.yoloVideoSelf.angle)
+                packet.display_image = self.display_scaler.scale_frame(packet.image)
+                self.display_buffer.put(packet)
+                on_frame = self.on_frame  # Cleared by the GUI when it lets go of this pipeline
+                if on_frame is not None:
+                    on_frame()
+            if time.monotonic() - last_report > REPORT_SECONDS:
+                last_report = time.monotonic()
+                print(self.report())
+            if self.metrics_file and time.monotonic() - last_metrics > self.metrics_seconds:
+                last_metrics = time.monotonic()
+                self.recorder.call(write_metrics, self.metrics_file, self.metrics(),
+                                   self.settings.get('event_log_max_bytes', 1000000),
+                                   self.settings.get('event_log_backups', 3))
@@ -1,22 +1,45 @@
-import glob
 import os
 import time
 import yaml
+from datetime import datetime
 from munch import munchify
 
-
+import cv2
+import numpy as np
 from PyQt5.QtCore import Qt, QDir, QUrl
+from PyQt5.QtGui import QImage, QPixmap
 from PyQt5.QtMultimedia import QMediaPlayer, QMediaContent
 from PyQt5.QtMultimediaWidgets import QVideoWidget
 from PyQt5.QtWidgets import QWidget, QPushButton, QStyle, QSlider, QLabel, \
-    QSizePolicy, QHBoxLayout, QVBoxLayout, QFileDialog
+    QSizePolicy, QHBoxLayout, QVBoxLayout, QFileDialog, QComboBox
+
+from clip_index import ClipIndex, thumbnail_at
+from recording_catalog import get_catalog
+from segments import SegmentManifest, locate
+from timeline_widget import AngleTimeline
 
 RECORD_FOLDER = None
 
 class VideoPlayer(QWidget):
-    def __init__(self, parent=None, record_folder=None):
+    # cameras: (name, folder) of every camera, picked with a selector, for when each one records
+    # into its own folder; record_folder is then the first camera's
+    def __init__(self, parent=None, record_folder=None, catalog=None, cameras=None):
         super(VideoPlayer, self).__init__(parent)
+        self.cameras = list(cameras or [])
+        if self.cameras:
+            record_folder = self.cameras[0][1]
         self.RECORD_FOLDER = record_folder
+        if catalog is None:
+            catalog = get_catalog(munchify(yaml.safe_load(open("config/config.yml"))))
+        self.catalog = catalog
+        self.currentFile = None
+        # A folder recorded in segments plays as one timeline, seeking by wall clock time
+        self.manifest = SegmentManifest(record_folder)
+        self.segments = []
+        self.segmentIndex = None  # None while playing a single file
+        self.pendingPosition = None  # Seek once the segment just opened has loaded
+        self.thumbnails = None  # Of the current clip's ClipIndex sidecar
+        self.previewPixels = None
         self.mediaPlayer = QMediaPlayer(None, QMediaPlayer.VideoSurface)
 
         videoWidget = QVideoWidget()
@@ -31,6 +54,16 @@ class VideoPlayer(QWidget):
         self.positionSlider.setRange(0, 0)
         self.positionSlider.sliderMoved.connect(self.setPosition)
 
+        self.timeLabel = QLabel()
+
+        # Angle of every frame from the clip's sidecar, with a thumbnail of where the mouse points
+        self.timeline = AngleTimeline()
+        self.timeline.seekRequested.connect(self.seekFraction)
+        self.timeline.hovered.connect(self.showPreview)
+        self.preview = QLabel()
+        self.preview.setFixedSize(160, 90)
+        self.preview.setAlignment(Qt.AlignCenter)
+
         self.error = QLabel()
         self.error.setSizePolicy(QSizePolicy.Preferred, QSizePolicy.Maximum)
 
@@ -39,6 +72,11 @@ class VideoPlayer(QWidget):
         self.openButton.setStatusTip("Open Video File")
         self.openButton.clicked.connect(self.openFile)
 
+        self.cameraSelector = QComboBox()
+        self.cameraSelector.addItems([name for name, folder in self.cameras])
+        self.cameraSelector.setVisible(len(self.cameras) > 1)
+        self.cameraSelector.currentIndexChanged.connect(lambda i: self.setFolder(self.cameras[i][1]))
+
         # Create a widget for window contents
         # wid = QWidget(self)
         # self.setCentralWidget(wid)
@@ -46,12 +84,20 @@ class VideoPlayer(QWidget):
         # Create layouts to place inside widget
         controlLayout = QHBoxLayout()
         controlLayout.setContentsMargins(0, 0, 0, 0)
+        controlLayout.addWidget(self.cameraSelector)
         controlLayout.addWidget(self.openButton)
         controlLayout.addWidget(self.playButton)
         controlLayout.addWidget(self.positionSlider)
+        controlLayout.addWidget(self.timeLabel)
+
+        timelineLayout = QHBoxLayout()
+        timelineLayout.setContentsMargins(0, 0, 0, 0)
+        timelineLayout.addWidget(self.timeline)
+        timelineLayout.addWidget(self.preview)
 
         layout = QVBoxLayout()
         layout.addWidget(videoWidget)
+        layout.addLayout(timelineLayout)
         layout.addLayout(controlLayout)
         layout.addWidget(self.error)
 
@@ -62,6 +108,7 @@ class VideoPlayer(QWidget):
         self.mediaPlayer.stateChanged.connect(self.mediaStateChanged)
         self.mediaPlayer.positionChanged.connect(self.positionChanged)
         self.mediaPlayer.durationChanged.connect(self.durationChanged)
+        self.mediaPlayer.mediaStatusChanged.connect(self.mediaStatusChanged)
         self.mediaPlayer.error.connect(self.handleError)
         self.installEventFilter(self)
 
@@ -70,14 +117,24 @@ class VideoPlayer(QWidget):
             self.openLatestFile()
         return False
 
+    # Move and Show events come often, the catalog answers without listing the folder and
+    # the player is only reloaded when there is a newer clip. Files copied in by hand show up
+    # once the retention thread has reconciled the folder, never probed on the GUI thread
     def openLatestFile(self):
-        currentDir = os.path.dirname(os.path.abspath(__file__))
-        list_of_files = glob.glob(currentDir + '/' + self.RECORD_FOLDER + '/*')  # * means all if need specific format then *.csv
-        print(str(list_of_files))
-        if list_of_files and len(list_of_files) != 0:  # Empty list
-            print(str(list_of_files))
-            latest_file = max(list_of_files, key=os.path.getctime)
-            print(str(latest_file) + ' ++++++++++++++++++++++++')
+        if self.refreshSegments():
+            latest = len(self.segments) - 1
+            if self.segmentIndex != latest and self.mediaPlayer.state() != QMediaPlayer.PlayingState:
+                self.loadSegment(latest)
+
+                # place a video frame in the playback widget
+                self.play()
+                time.sleep(.1)
+                self.play()
+            return
+        latest_file = self.catalog.latest(self.RECORD_FOLDER)
+        if latest_file is not None and latest_file != self.currentFile:
+            self.currentFile = latest_file
+            self.loadIndex(latest_file)
             self.mediaPlayer.setMedia(
                 QMediaContent(QUrl.fromLocalFile(latest_file)))
             self.playButton.setEnabled(True)
@@ -87,11 +144,32 @@ class VideoPlayer(QWidget):
             time.sleep(.1)
             self.play()
 
+    # Play another camera's recordings, starting from its latest
+    def setFolder(self, folder):
+        self.mediaPlayer.stop()
+        self.mediaPlayer.setMedia(QMediaContent())
+        self.playButton.setEnabled(False)
+        self.RECORD_FOLDER = folder
+        self.manifest = SegmentManifest(folder)
+        self.segments = []
+        self.segmentIndex = None
+        self.currentFile = None
+        self.pendingPosition = None
+        self.positionSlider.setRange(0, 0)
+        self.timeLabel.clear()
+        self.thumbnails = None
+        self.timeline.setAngles(None)
+        self.preview.clear()
+        self.openLatestFile()
+
     def openFile(self):
         fileName, _ = QFileDialog.getOpenFileName(self, "Open Movie",
                                                   QDir.path(QDir(self.RECORD_FOLDER)))
         print (str(fileName) + '--------------------')
         if fileName != '':
+            self.segmentIndex = None
+            self.timeLabel.clear()
+            self.loadIndex(fileName)
             self.mediaPlayer.setMedia(
                 QMediaContent(QUrl.fromLocalFile(fileName)))
             self.playButton.setEnabled(True)
@@ -115,14 +193,88 @@ class VideoPlayer(QWidget):
             self.playButton.setIcon(
                 self.style().standardIcon(QStyle.SP_MediaPlay))
 
+    # Re-read the manifest, returns False when the folder is not recorded in segments
+    def refreshSegments(self):
+        self.segments = self.manifest.segments()
+        if not self.segments:
+            return False
+        if self.segmentIndex is not None:  # Retention may have removed older segments
+            paths = [os.path.abspath(segment.path) for segment in self.segments]
+            self.segmentIndex = paths.index(self.currentFile) if self.currentFile in paths else None
+        self.positionSlider.setRange(0, int((self.segments[-1].end - self.segments[0].start) * 1000))
+        return True
+
+    # Open a segment only when playback or a seek reaches it, offset is seconds into its file
+    def loadSegment(self, index, offset=0.0):
+        segment = self.segments[index]
+        if index == self.segmentIndex:
+            self.mediaPlayer.setPosition(int(offset * 1000))
+            return
+        self.segmentIndex = index
+        self.currentFile = os.path.abspath(segment.path)
+        self.pendingPosition = int(offset * 1000) if offset > 0 else None
+        self.loadIndex(self.currentFile)
+        self.mediaPlayer.setMedia(QMediaContent(QUrl.fromLocalFile(self.currentFile)))
+        self.playButton.setEnabled(True)
+
+    # Jump to what was recorded at a wall clock time, or the next recording after a gap
+    def seekTime(self, wall_time):
+        index = locate(self.segments, wall_time)
+        if index is not None:
+            self.loadSegment(index, self.segments[index].to_offset(wall_time))
+
+    def mediaStatusChanged(self, status):
+        if self.segmentIndex is None:
+            return
+        if status in (QMediaPlayer.LoadedMedia, QMediaPlayer.BufferedMedia) and self.pendingPosition is not None:
+            self.mediaPlayer.setPosition(self.pendingPosition)
+            self.pendingPosition = None
+        elif status == QMediaPlayer.EndOfMedia:
+            if self.segmentIndex + 1 >= len(self.segments):
+                self.refreshSegments()  # Anything recorded since?
+            if self.segmentIndex is not None and self.segmentIndex + 1 < len(self.segments):
+                self.loadSegment(self.segmentIndex + 1)
+                self.mediaPlayer.play()
+
+    # The sidecar is memory mapped, nothing of the video is decoded
+    def loadIndex(self, path):
+        index = ClipIndex.load(path)
+        angles, self.thumbnails = index if index is not None else (None, None)
+        self.timeline.setAngles(angles)
+        self.timeline.setPosition(0.0)
+        self.preview.clear()
+
+    def seekFraction(self, fraction):
+        self.mediaPlayer.setPosition(int(fraction * self.mediaPlayer.duration()))
+
+    def showPreview(self, fraction):
+        if self.thumbnails is None or not len(self.thumbnails):
+            return
+        thumbnail = cv2.cvtColor(np.ascontiguousarray(thumbnail_at(self.thumbnails, fraction)), cv2.COLOR_BGR2RGB)
+        self.previewPixels = thumbnail  # QImage does not own its pixels
+        image = QImage(thumbnail.data, thumbnail.shape[1], thumbnail.shape[0], thumbnail.strides[0],
+                       QImage.Format_RGB888)
+        self.preview.setPixmap(QPixmap.fromImage(image))
+
     def positionChanged(self, position):
-        self.positionSlider.setValue(position)
+        if self.mediaPlayer.duration() > 0:
+            self.timeline.setPosition(position / self.mediaPlayer.duration())
+        if self.segmentIndex is None:
+            self.positionSlider.setValue(position)
+            return
+        wall_time = self.segments[self.segmentIndex].to_wall(position / 1000)
+        self.positionSlider.setValue(int((wall_time - self.segments[0].start) * 1000))
+        self.timeLabel.setText(datetime.fromtimestamp(wall_time).strftime('%H:%M:%S'))
 
     def durationChanged(self, duration):
-        self.positionSlider.setRange(0, duration)
+        if self.segmentIndex is None:
+            self.positionSlider.setRange(0, duration)
 
     def setPosition(self, position):
-        self.mediaPlayer.setPosition(position)
+        if self.segmentIndex is None:
+            self.mediaPlayer.setPosition(position)
+        else:
+            self.seekTime(self.segments[0].start + position / 1000)
 
     def handleError(self):
         self.playButton.setEnabled(False)
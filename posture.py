@@ -0,0 +1,156 @@
+import time
+
+import cv2
+import numpy as np
+
+# The posture math of YoloVideoSelf without any of its recording, alerts or event log, so offline
+# tools (batch_analysis, compare_models, the benchmarks) can use it without side effects
+
+EAR_CLASSES = (0,)
+NOSE_CLASSES = (1, 2)
+# Ear-nose angles outside these limits are poor posture
+POSTERIOR_ANGLE = -13
+ANTERIOR_ANGLE = 12
+ALARM_SECONDS = 5  # Poor posture held this long sounds the alarm
+THRESHOLD = 0.2
+# the lower the value: the fewer bounding boxes will remain
+SUPPRESSION_THRESHOLD = 0.4
+YOLO_IMAGE_SIZE = 416
+
+
+# Forward pass and decode only, so it can run on a different thread than the annotation
+# timings, when given, receives the seconds spent in each step (preprocess, forward, decode, nms)
+# region (x, y, w, h) runs the network on that crop only, at input_size if given;
+# the boxes are in frame coordinates either way
+def detect(frame, model, timings=None, region=None, input_size=None, threshold=THRESHOLD,
+           suppression_threshold=SUPPRESSION_THRESHOLD):
+    if region is not None:
+        x, y, w, h = region
+        frame = frame[y:y + h, x:x + w]
+    model_outputs = model.forward(frame, timings, input_size)
+    detections = find_objects(model_outputs, frame.shape[1], frame.shape[0], timings, threshold,
+                              suppression_threshold)
+    if region is not None:
+        detections[1][:, :2] += (x, y)
+    return detections
+
+
+# Several frames in one forward pass, e.g. offline re-analysis or one frame from each camera
+def detect_batch(frames, model):
+    return [find_objects(model_outputs, frame.shape[1], frame.shape[0])
+            for frame, model_outputs in zip(frames, model.forward_batch(frames))]
+
+
+# Decode both output layers in one batched NumPy pass, boxes scaled straight to frame coordinates
+def find_objects(model_outputs, frame_width=None, frame_height=None, timings=None, threshold=THRESHOLD,
+                 suppression_threshold=SUPPRESSION_THRESHOLD):
+    start = time.perf_counter()
+    frame_width = frame_width or YOLO_IMAGE_SIZE
+    frame_height = frame_height or YOLO_IMAGE_SIZE
+    predictions = np.concatenate([output.reshape(-1, output.shape[-1]) for output in model_outputs])
+
+    class_probabilities = predictions[:, 5:]
+    class_ids = np.argmax(class_probabilities, axis=1)
+    confidence_values = class_probabilities[np.arange(len(class_ids)), class_ids]
+    keep = confidence_values > threshold
+    predictions, class_ids, confidence_values = predictions[keep], class_ids[keep], confidence_values[keep]
+
+    # centre x, centre y, width, height -> top left x, top left y, width, height
+    scale = np.array([frame_width, frame_height], dtype=np.float32)
+    sizes = predictions[:, 2:4] * scale
+    corners = predictions[:, 0:2] * scale - sizes / 2
+    bounding_box_locations = np.hstack((corners, sizes)).astype(np.int32)
+
+    decoded = time.perf_counter()
+    if timings is not None:
+        timings['decode'] = decoded - start
+        timings['nms'] = 0.0
+    if len(bounding_box_locations) == 0:
+        return [], bounding_box_locations, class_ids, confidence_values
+    box_indexes_to_keep = cv2.dnn.NMSBoxes(bounding_box_locations.tolist(), confidence_values.tolist(),
+                                           threshold, suppression_threshold)
+    if timings is not None:
+        timings['nms'] = time.perf_counter() - decoded
+
+    return np.asarray(box_indexes_to_keep).reshape(-1), bounding_box_locations, class_ids, confidence_values
+
+
+def head_boxes(bounding_box_ids, all_bounding_boxes, class_ids, confidence_values=None, width_ratio=1,
+               height_ratio=1):
+    """The ear and nose boxes among the detections kept by NMS, as ('ear' or 'nose', (x, y, w, h),
+    confidence); the ratios scale the boxes, e.g. from a resized image back to the frame."""
+    boxes = []
+    for index in bounding_box_ids:
+        if class_ids[index] in NOSE_CLASSES:
+            kind = 'nose'
+        elif class_ids[index] in EAR_CLASSES:
+            kind = 'ear'
+        else:
+            continue
+        x, y, w, h = [int(value) for value in all_bounding_boxes[index]]
+        box = int(x * width_ratio), int(y * height_ratio), int(w * width_ratio), int(h * height_ratio)
+        boxes.append((kind, box, confidence_values[index] if confidence_values is not None else None))
+    return boxes
+
+
+# Ear and nose centres and the angle between them from head_boxes, None for what was not found;
+# with several boxes of a kind the last one counts
+def head_angle(boxes):
+    centres = {}
+    for kind, (x, y, w, h), confidence in boxes:
+        centres[kind] = (x + (w // 2), y + (h // 2))
+    ear, nose = centres.get('ear'), centres.get('nose')
+    angle = posture_angle(ear, nose) if ear is not None and nose is not None else None
+    return ear, nose, angle
+
+
+# Ear and nose centres and the angle between them, without drawing or recording anything
+def measure(bounding_box_ids, all_bounding_boxes, class_ids):
+    return head_angle(head_boxes(bounding_box_ids, all_bounding_boxes, class_ids))
+
+
+def is_poor_posture(angle, posterior_angle=POSTERIOR_ANGLE, anterior_angle=ANTERIOR_ANGLE):
+    return angle < posterior_angle or angle > anterior_angle
+
+
+def posture_angle(ear, nose):
+    if nose[0] == ear[0]:  # Vertical
+        return 90.0 if nose[1] > ear[1] else -90.0
+    slope = (nose[1] - ear[1]) / (nose[0] - ear[0])
+    return np.arctan(slope) * 57.2958
+
+
+class PostureTimer:
+    """The poor posture alarm timer, on frame timestamps.
+
+    update() takes whether each frame is in poor posture (None when the head was not found,
+    which leaves the timer as it is) and returns the event it caused: 'poor_start',
+    'alarm' once poor posture has been held for alarm_seconds, which restarts the timer,
+    'returned_good', or None.
+    """
+
+    def __init__(self, alarm_seconds=ALARM_SECONDS):
+        self.alarm_seconds = alarm_seconds
+        self.started = False
+        self.since = None  # Timestamp poor posture started
+
+    def update(self, poor, timestamp):
+        if poor is None:
+            return None
+        if not poor:
+            if self.started:
+                self.started = False
+                return 'returned_good'
+            return None
+        if not self.started:
+            self.started = True
+            self.since = timestamp
+            return 'poor_start'
+        if timestamp - self.since > self.alarm_seconds:
+            self.started = False  # The live app resets the timer once the alarm has sounded
+            return 'alarm'
+        return None
+
+    # Seconds of poor posture so far, or until the last event
+    def seconds(self, timestamp):
+        return timestamp - self.since if self.since is not None else 0.0
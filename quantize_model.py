@@ -0,0 +1,95 @@
+# INT8 quantization of the ONNX export of the network, calibrated on recorded clips
+#
+# The input is the FP32 model written by export_onnx.py (model_onnx), other ONNX exports do not
+# have the output layout the app reads. Static quantization: the activation ranges are measured
+# on real frames from the recordings, so pick clips with the usual lighting and sitting positions.
+# Only the convolutions are quantized, the YOLO decode at the end of the graph stays FP32 so the
+# box coordinates keep their precision. Check the result against the FP32 model with
+# compare_models.py before pointing model_onnx at it.
+#
+# Usage (from the repository root):
+#   python export_onnx.py
+#   python quantize_model.py record good --output config/yolov4-tiny_best-5.int8.onnx --frames 200
+import argparse
+import os
+import sys
+
+import cv2
+import yaml
+from munch import munchify
+
+from batch_analysis import find_videos
+from yolo_model import YoloModel
+
+try:
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+except ImportError:
+    CalibrationDataReader = object
+    quantize_static = None
+
+
+class ClipCalibration(CalibrationDataReader):
+    """Network inputs packed exactly as YoloModel feeds them, from every Nth frame of the clips."""
+
+    def __init__(self, model, videos, frames=200, every=10):
+        self.model = model
+        self.videos = videos
+        self.frames = frames
+        self.every = every
+        self.count = 0
+        self._blobs = self._read()
+
+    def _read(self):
+        for path in self.videos:
+            capture = cv2.VideoCapture(path)
+            frame_index = 0
+            while self.count < self.frames:
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                if frame_index % self.every == 0:
+                    self.count += 1
+                    yield {self.model.backend.input_name: self.model.preprocess(frame).copy()}
+                frame_index += 1
+            capture.release()
+
+    def get_next(self):
+        return next(self._blobs, None)
+
+
+def main():
+    settings = munchify(yaml.safe_load(open("config/config.yml")))
+    parser = argparse.ArgumentParser(description="INT8 quantization of the ONNX model, calibrated on recordings")
+    parser.add_argument('paths', nargs='+', help="video files or directories of recordings to calibrate on")
+    parser.add_argument('--model', default=settings.get('model_onnx'), help="FP32 ONNX model (default: model_onnx)")
+    parser.add_argument('--output', help="INT8 model (default: the model name with .int8 before .onnx)")
+    parser.add_argument('--frames', type=int, default=200, help="calibration frames (default: 200)")
+    parser.add_argument('--every', type=int, default=10, help="use every Nth frame of a clip (default: 10)")
+    parser.add_argument('--per-channel', action='store_true', help="per channel weight scales, usually more accurate")
+    args = parser.parse_args()
+
+    if quantize_static is None:
+        print("onnxruntime is not installed: pip install onnxruntime")
+        sys.exit(1)
+    if not args.model or not os.path.isfile(args.model):
+        print("No FP32 ONNX model at %s: export the model first with python export_onnx.py --output %s" % (
+            args.model, args.model or 'config/yolov4-tiny_best-5.onnx'))
+        sys.exit(1)
+    videos = find_videos(args.paths)
+    if not videos:
+        print("No videos found")
+        sys.exit(1)
+    output = args.output or os.path.splitext(args.model)[0] + '.int8.onnx'
+
+    model = YoloModel(settings.get('model_weights'), settings.get('model_cfg'), 'onnxruntime', args.model)
+    calibration = ClipCalibration(model, videos, args.frames, args.every)
+    # QDQ keeps the graph runnable by any ONNX Runtime execution provider
+    quantize_static(args.model, output, calibration, quant_format=QuantFormat.QDQ,
+                    activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8, per_channel=args.per_channel,
+                    op_types_to_quantize=['Conv'])
+    print("Calibrated on %d frames from %d videos, wrote %s (%.1f MB, FP32 %.1f MB)" % (
+        calibration.count, len(videos), output, os.path.getsize(output) / 1e6, os.path.getsize(args.model) / 1e6))
+
+
+if __name__ == '__main__':
+    main()
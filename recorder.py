@@ -0,0 +1,293 @@
+import collections
+import os
+import threading
+import time
+
+import cv2
+
+from clip_index import ClipIndex
+from recording_catalog import AngleStats
+
+
+class PreRollBuffer:
+    """The last few seconds of frames, downscaled and JPEG compressed to keep memory small,
+    so a clip can be written after the fact instead of encoding every event as it happens."""
+
+    def __init__(self, seconds=8, scale=0.5, jpeg_quality=80):
+        self.seconds = seconds
+        self.scale = scale
+        self.jpeg_quality = jpeg_quality  # 0 keeps raw (downscaled) frames
+        self._frames = collections.deque()
+
+    def add(self, frame, timestamp, angle=None):
+        if self.scale != 1:
+            frame = cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        if self.jpeg_quality:
+            ok, frame = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+            if not ok:
+                return
+        self._frames.append((timestamp, frame, angle))
+        while timestamp - self._frames[0][0] > self.seconds:
+            self._frames.popleft()
+
+    def __len__(self):
+        return len(self._frames)
+
+    # Hand the buffered frames over and start afresh, so the next clip does not repeat them
+    def take(self):
+        taken = PreRollBuffer(self.seconds, self.scale, self.jpeg_quality)
+        taken._frames, self._frames = self._frames, collections.deque()
+        return taken
+
+    # Frame rate the buffered frames actually arrived at, so the clip plays back in real time
+    def fps(self):
+        if len(self._frames) < 2:
+            return 10.0
+        return (len(self._frames) - 1) / max(self._frames[-1][0] - self._frames[0][0], 1e-3)
+
+    def frames(self):
+        for timestamp, frame, angle in self._frames:
+            yield cv2.imdecode(frame, cv2.IMREAD_COLOR) if self.jpeg_quality else frame
+
+    # Angle of each frame, in the order of frames()
+    def frame_angles(self):
+        return [angle for timestamp, frame, angle in self._frames]
+
+    def angles(self):
+        stats = AngleStats()
+        for timestamp, frame, angle in self._frames:
+            stats.add(angle)
+        return stats
+
+
+class ClipStats:
+    """What the recorder knows about an open clip, for the catalog and the segment manifest."""
+
+    def __init__(self, fps, manifest=None, index=None):
+        self.fps = fps
+        self.manifest = manifest
+        self.index = index  # ClipIndex sidecar, None to not write one
+        self.frames = 0
+        self.angles = AngleStats()
+        self.start = None
+        self.end = None
+
+    def add(self, angle, timestamp, frame=None):
+        if self.index is not None and frame is not None:
+            self.index.add(frame, angle)
+        self.frames += 1
+        self.angles.add(angle)
+        if self.start is None:
+            self.start = timestamp
+        self.end = timestamp
+
+
+class RecorderService:
+    """Owns the posture VideoWriters and does all encoding and file work on its own thread.
+
+    Writers are addressed by a key ('poor', 'good'). Commands are queued and run in order;
+    frames beyond max_queued_frames are dropped and counted so a stalled disk or encoder
+    never holds up detection. Opening, releasing and deleting files are never dropped.
+    Buffered frames go into a PreRollBuffer that save_preroll() empties into one clip,
+    written on a thread of its own so the recorder keeps taking frames meanwhile.
+    The per frame work (writing, or compressing into the pre-roll) is timed into stats.
+    Finished clips are added to the catalog, with their length and posture angles, and
+    to the SegmentManifest they were opened with. Unless thumbnail_every is 0 each clip
+    also gets a ClipIndex sidecar for the player's timeline.
+    """
+
+    def __init__(self, max_queued_frames=30, preroll=None, stats=None, catalog=None, thumbnail_every=10,
+                 thumbnail_width=160):
+        self.max_queued_frames = max_queued_frames
+        self.preroll = preroll if preroll is not None else PreRollBuffer()
+        self.stats = stats
+        self.catalog = catalog
+        self.thumbnail_every = thumbnail_every
+        self.thumbnail_width = thumbnail_width
+        self.queued_frames = 0
+        self.written = 0
+        self.dropped = 0
+        self.encode_time = 0.0
+        self._commands = collections.deque()
+        self._cond = threading.Condition()
+        self._writers = {}
+        self._paths = {}
+        self._clips = {}  # key: ClipStats
+        self._savers = []  # Threads writing pre-roll clips
+        self._thread = threading.Thread(target=self._run, name='recorder', daemon=True)
+        self._thread.start()
+
+    def open(self, key, path, codec, fps, size, manifest=None):
+        self._submit((self._open, key, path, codec, fps, size, manifest))
+
+    def write(self, key, frame, angle=None, timestamp=None):
+        return self._submit_frame((self._write, key, frame, angle, timestamp if timestamp is not None else time.time()))
+
+    def buffer(self, frame, timestamp=None, angle=None):
+        return self._submit_frame((self._buffer, frame, timestamp if timestamp is not None else time.time(), angle))
+
+    # Write the pre-roll buffer out as a clip, e.g. when a poor posture alarm fires
+    def save_preroll(self, path, codec):
+        self._submit((self._save_preroll, path, codec))
+
+    def release(self, key, delete=False):
+        self._submit((self._release, key, delete))
+
+    # Run any other file work (e.g. retention) on the recorder thread, in order with the writes
+    def call(self, function, *args):
+        self._submit((function,) + args)
+
+    def stop(self, timeout=5.0):
+        self._submit(None)
+        self._thread.join(timeout)
+        for saver in self._savers:
+            saver.join(timeout)
+
+    def queue_depth(self):
+        with self._cond:
+            return self.queued_frames
+
+    def summary(self):
+        with self._cond:
+            encode = self.encode_time / self.written * 1000 if self.written else 0.0
+            return "recorder   %6d frames %6d dropped %6d queued  avg %6.1f ms" % (
+                self.written, self.dropped, self.queued_frames, encode)
+
+    def _submit_frame(self, command):
+        with self._cond:
+            if self.queued_frames >= self.max_queued_frames:
+                self.dropped += 1
+                return False
+            self.queued_frames += 1
+            self._commands.append(command)
+            self._cond.notify()
+        return True
+
+    def _submit(self, command):
+        with self._cond:
+            self._commands.append(command)
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._commands:
+                    self._cond.wait()
+                command = self._commands.popleft()
+                if command is not None and command[0] in (self._write, self._buffer):
+                    self.queued_frames -= 1
+            if command is None:
+                break
+            try:
+                command[0](*command[1:])
+            except Exception as e:
+                print("Error: recorder %s failed: %s" % (command[0].__name__, e))
+        for key in list(self._writers):
+            self._release(key)
+
+    def _open(self, key, path, codec, fps, size, manifest=None):
+        if key in self._writers:
+            self._release(key)
+        if self.catalog is not None:
+            self.catalog.writing(path)
+        writer = cv2.VideoWriter(path, codec, fps, size)
+        if not writer.isOpened():
+            print("************ Failed to create %s posture writer %s ************" % (key, path))
+            if self.catalog is not None:
+                self.catalog.done_writing(path)
+            return
+        self._writers[key] = writer
+        self._paths[key] = path
+        self._clips[key] = ClipStats(fps, manifest, self._new_index())
+
+    def _write(self, key, frame, angle=None, timestamp=None):
+        writer = self._writers.get(key)
+        if writer is None:
+            return
+        start = time.monotonic()
+        writer.write(frame)
+        seconds = time.monotonic() - start
+        self.encode_time += seconds
+        self.written += 1
+        self._clips[key].add(angle, timestamp if timestamp is not None else time.time(), frame)
+        if self.stats is not None:
+            self.stats.record(seconds)
+
+    def _buffer(self, frame, timestamp, angle=None):
+        start = time.monotonic()
+        self.preroll.add(frame, timestamp, angle)
+        if self.stats is not None:
+            self.stats.record(time.monotonic() - start)
+
+    def _save_preroll(self, path, codec):
+        if not len(self.preroll):
+            return
+        # Decoding and encoding seconds of video would hold up the writers and the pre-roll
+        saver = threading.Thread(target=self._write_preroll, args=(self.preroll.take(), path, codec),
+                                 name='preroll-save', daemon=True)
+        saver.start()
+        self._savers = [thread for thread in self._savers if thread.is_alive()] + [saver]
+
+    def _write_preroll(self, preroll, path, codec):
+        if self.catalog is not None:
+            self.catalog.writing(path)
+        try:
+            self._write_clip(preroll, path, codec)
+        except Exception as e:
+            print("Error: recorder _save_preroll failed: %s" % e)
+        finally:
+            if self.catalog is not None:
+                self.catalog.done_writing(path)  # Already done once the clip is added
+
+    def _write_clip(self, preroll, path, codec):
+        frames = preroll.frames()
+        first = next(frames)
+        fps = preroll.fps()
+        writer = cv2.VideoWriter(path, codec, fps, (first.shape[1], first.shape[0]))
+        if not writer.isOpened():
+            print("************ Failed to create poor posture clip %s ************" % path)
+            return
+        start = time.monotonic()
+        index = self._new_index()
+        angles = preroll.frame_angles()
+        writer.write(first)
+        if index is not None:
+            index.add(first, angles[0])
+        count = 1
+        for frame in frames:
+            writer.write(frame)
+            if index is not None:
+                index.add(frame, angles[count])
+            count += 1
+        writer.release()
+        if index is not None:
+            index.save(path)
+        with self._cond:
+            self.encode_time += time.monotonic() - start
+            self.written += count
+        if self.catalog is not None:
+            self.catalog.add(path, 'poor', count / fps, count, preroll.angles())
+
+    def _new_index(self):
+        return ClipIndex(self.thumbnail_every, self.thumbnail_width) if self.thumbnail_every else None
+
+    def _release(self, key, delete=False):
+        writer = self._writers.pop(key, None)
+        path = self._paths.pop(key, None)
+        clip = self._clips.pop(key, None)
+        if writer is not None:
+            writer.release()
+            if self.catalog is not None and not delete:
+                self.catalog.add(path, key, clip.frames / clip.fps, clip.frames, clip.angles)
+            if clip.index is not None and not delete:
+                clip.index.save(path)
+            if clip.manifest is not None and not delete and clip.frames:
+                clip.manifest.append(path, clip.start, clip.end, clip.frames / clip.fps, clip.frames, clip.angles)
+        if delete and path is not None:
+            try:
+                if os.path.isfile(path):
+                    os.remove(path)
+            except OSError as e:  ## if failed, report it back to the user ##
+                print("Error: %s - %s." % (e.filename, e.strerror))
+            if self.catalog is not None:
+                self.catalog.done_writing(path)
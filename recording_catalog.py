@@ -0,0 +1,186 @@
+import os
+import sqlite3
+import threading
+
+import cv2
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS clips (
+    path TEXT PRIMARY KEY,
+    folder TEXT NOT NULL,
+    kind TEXT,
+    created REAL NOT NULL,
+    duration REAL,
+    frames INTEGER,
+    size INTEGER,
+    angle_min REAL,
+    angle_max REAL,
+    angle_mean REAL
+);
+CREATE INDEX IF NOT EXISTS clips_folder_created ON clips (folder, created);
+'''
+
+
+class AngleStats:
+    """Running min, max and mean of the posture angle over one clip."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, angle):
+        if angle is None:
+            return
+        angle = float(angle)
+        self.count += 1
+        self.total += angle
+        self.min = angle if self.min is None else min(self.min, angle)
+        self.max = angle if self.max is None else max(self.max, angle)
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+
+class RecordingCatalog:
+    """SQLite index of the recorded clips, so the latest clip or the oldest ones to delete are
+    found with an indexed query instead of listing and stat'ing every file in the folder.
+
+    The recorder adds a clip once it is closed; reconcile() picks up files added or deleted
+    behind its back, and only rescans a folder when the folder's modification time changed.
+    Files the recorder marks as writing() are left alone until it adds them, so a half
+    written clip is never probed or listed.
+    """
+
+    def __init__(self, path='recordings.db'):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(SCHEMA)
+        self._folder_mtimes = {}
+        self._writing = set()
+
+    def add(self, path, kind=None, duration=None, frames=None, angles=None, created=None):
+        path = os.path.abspath(path)
+        with self._lock:
+            self._writing.discard(path)
+        try:
+            size = os.path.getsize(path)
+            created = created if created is not None else os.path.getmtime(path)
+        except OSError:
+            return  # The writer failed, there is no clip
+        angles = angles if angles is not None else AngleStats()
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO clips VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                               (path, os.path.dirname(path), kind, created, duration, frames, size,
+                                angles.min, angles.max, angles.mean()))
+
+    # The recorder is writing path, until it adds it or calls done_writing()
+    def writing(self, path):
+        with self._lock:
+            self._writing.add(os.path.abspath(path))
+
+    def done_writing(self, path):
+        with self._lock:
+            self._writing.discard(os.path.abspath(path))
+
+    def remove(self, path):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM clips WHERE path = ?', (os.path.abspath(path),))
+
+    def latest(self, folder):
+        with self._lock:
+            row = self._conn.execute('SELECT path FROM clips WHERE folder = ? ORDER BY created DESC LIMIT 1',
+                                     (os.path.abspath(folder),)).fetchone()
+        return row[0] if row else None
+
+    # Oldest first, e.g. the clips retention deletes first
+    def oldest(self, folder, limit=-1, offset=0):
+        with self._lock:
+            rows = self._conn.execute('SELECT path FROM clips WHERE folder = ? ORDER BY created LIMIT ? OFFSET ?',
+                                      (os.path.abspath(folder), limit, offset)).fetchall()
+        return [row[0] for row in rows]
+
+    # Every clip beyond the newest keep
+    def excess(self, folder, keep):
+        with self._lock:
+            rows = self._conn.execute('SELECT path FROM clips WHERE folder = ? ORDER BY created DESC '
+                                      'LIMIT -1 OFFSET ?', (os.path.abspath(folder), keep)).fetchall()
+        return [row[0] for row in reversed(rows)]
+
+    # Clips created before the given time, oldest first
+    def expired(self, folder, before):
+        with self._lock:
+            rows = self._conn.execute('SELECT path FROM clips WHERE folder = ? AND created < ? ORDER BY created',
+                                      (os.path.abspath(folder), before)).fetchall()
+        return [row[0] for row in rows]
+
+    # The oldest clips that do not fit in max_bytes once the newer ones are kept, oldest first
+    def over_size(self, folder, max_bytes):
+        with self._lock:
+            rows = self._conn.execute('SELECT path FROM (SELECT path, created, SUM(size) OVER '
+                                      '(ORDER BY created DESC) AS kept FROM clips WHERE folder = ?) '
+                                      'WHERE kept > ? ORDER BY created', (os.path.abspath(folder), max_bytes)).fetchall()
+        return [row[0] for row in rows]
+
+    # Number of clips and their total size in bytes
+    def usage(self, folder):
+        with self._lock:
+            count, size = self._conn.execute('SELECT COUNT(*), TOTAL(size) FROM clips WHERE folder = ?',
+                                             (os.path.abspath(folder),)).fetchone()
+        return count, int(size)
+
+    def reconcile(self, folder, kind=None):
+        """Bring the folder's entries in line with the files on disk, returns (added, removed)."""
+        folder = os.path.abspath(folder)
+        try:
+            mtime = os.stat(folder).st_mtime
+        except OSError:
+            mtime = None  # The folder is gone, and its clips with it
+        if mtime is not None and self._folder_mtimes.get(folder) == mtime:
+            return 0, 0  # No file was added, removed or renamed since the last scan
+        on_disk = set()
+        if mtime is not None:
+            with os.scandir(folder) as entries:
+                on_disk = {entry.path for entry in entries
+                           if entry.is_file() and entry.name.lower().endswith(VIDEO_EXTENSIONS)}
+        with self._lock:
+            known = {row[0] for row in self._conn.execute('SELECT path FROM clips WHERE folder = ?', (folder,))}
+            known -= self._writing
+            on_disk -= self._writing
+        for path in known - on_disk:
+            self.remove(path)
+        for path in on_disk - known:
+            duration, frames = probe_clip(path)
+            self.add(path, kind, duration, frames)
+        self._folder_mtimes[folder] = mtime
+        return len(on_disk - known), len(known - on_disk)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# Duration in seconds and number of frames of a clip, from its header
+def probe_clip(path):
+    capture = cv2.VideoCapture(path)
+    frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    capture.release()
+    return (frames / fps if fps else None), frames
+
+
+_catalogs_lock = threading.Lock()
+_catalogs = {}
+
+
+def get_catalog(settings):
+    """The RecordingCatalog of the configured file, shared by the recorders and the players."""
+    path = settings.get('catalog_file', 'recordings.db')
+    with _catalogs_lock:
+        if path not in _catalogs:
+            _catalogs[path] = RecordingCatalog(path)
+        return _catalogs[path]
@@ -0,0 +1,158 @@
+import os
+import shutil
+import threading
+import time
+
+from clip_index import ClipIndex
+from recording_catalog import get_catalog
+from segments import SegmentManifest
+
+MB = 1024 * 1024
+
+
+class RetentionPolicy:
+    """Limits for the clips of one folder; None leaves that limit off."""
+
+    def __init__(self, max_clips=None, max_mb=None, max_age_days=None):
+        self.max_clips = max_clips
+        self.max_mb = max_mb
+        self.max_age_days = max_age_days
+
+    @classmethod
+    def from_settings(cls, values):
+        values = values or {}
+        return cls(values.get('max_clips'), values.get('max_mb'), values.get('max_age_days'))
+
+
+class RetentionManager:
+    """Keeps the recording folders within their RetentionPolicy and the disk above min_free_mb.
+
+    Runs on its own thread every interval seconds, or sooner after request(), so the
+    recorder and the frame threads never wait on a delete. Clips to delete come from the
+    RecordingCatalog, oldest first, and are deleted at most batch_size per pass.
+    """
+
+    def __init__(self, catalog, policies, interval=300, batch_size=20, min_free_mb=None):
+        self.catalog = catalog
+        self.policies = policies  # kind ('poor', 'good') -> RetentionPolicy
+        self.interval = interval
+        self.batch_size = batch_size
+        self.min_free_mb = min_free_mb
+        self.deleted = 0
+        self.deleted_bytes = 0
+        self._folders = {}  # folder -> kind
+        self._failed = set()  # Clips that could not be deleted, skipped until the next scheduled pass
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='retention', daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def from_settings(cls, settings):
+        policies = {kind: RetentionPolicy.from_settings(values)
+                    for kind, values in (settings.get('retention') or {}).items()}
+        return cls(get_catalog(settings), policies, settings.get('retention_interval', 300),
+                   settings.get('retention_batch', 20), settings.get('retention_min_free_mb'))
+
+    def watch(self, folder, kind):
+        with self._lock:
+            self._folders[folder] = kind
+        self.request()
+
+    # Run a pass soon, e.g. when a clip was just finished
+    def request(self):
+        self._wake.set()
+
+    def usage(self):
+        """{folder: (clips, bytes)} of the watched folders."""
+        with self._lock:
+            folders = list(self._folders)
+        return {folder: self.catalog.usage(folder) for folder in folders}
+
+    def report(self):
+        lines = ["retention  %6d clips %8.1f MB deleted" % (self.deleted, self.deleted_bytes / MB)]
+        for folder, (count, size) in sorted(self.usage().items()):
+            lines.append("  %-20s %6d clips %8.1f MB" % (folder, count, size / MB))
+        free = self._free_mb()
+        if free is not None:
+            lines.append("  %-20s %15.1f MB free" % ('disk', free))
+        return '\n'.join(lines)
+
+    def _free_mb(self):
+        with self._lock:
+            folders = [folder for folder in self._folders if os.path.isdir(folder)]
+        if not folders:
+            return None
+        return shutil.disk_usage(folders[0]).free / MB
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self._failed.clear()  # e.g. a clip held open by the player, try it again
+            try:
+                while self._pass():
+                    time.sleep(0.1)  # More to delete, let the disk breathe between batches
+            except Exception as e:
+                print("Error: retention pass failed: %s" % e)
+
+    # One batch: True when it was full, so there may be more to delete. A clip that fails to delete
+    # is left out of the passes that follow, so it cannot keep the batch full forever
+    def _pass(self):
+        with self._lock:
+            folders = list(self._folders.items())
+        now = time.time()
+        doomed = []
+        for folder, kind in folders:
+            self.catalog.reconcile(folder, kind)
+            policy = self.policies.get(kind)
+            if policy is None:
+                continue
+            if policy.max_age_days is not None:
+                doomed += self.catalog.expired(folder, now - policy.max_age_days * 86400)
+            if policy.max_clips is not None:
+                doomed += self.catalog.excess(folder, policy.max_clips)
+            if policy.max_mb is not None:
+                doomed += self.catalog.over_size(folder, policy.max_mb * MB)
+        doomed = [path for path in dict.fromkeys(doomed) if path not in self._failed][:self.batch_size]
+        free = self._free_mb()
+        if self.min_free_mb is not None and free is not None and free < self.min_free_mb and not doomed:
+            # Disk nearly full: give up the oldest clips, good posture ones before poor posture ones
+            for kind in ('good', 'poor'):
+                for folder in [folder for folder, folder_kind in folders if folder_kind == kind]:
+                    doomed += self.catalog.oldest(folder, self.batch_size + len(self._failed))
+            doomed = [path for path in doomed if path not in self._failed][:self.batch_size]
+        deleted = [path for path in doomed if self._delete(path)]
+        for folder in set(os.path.dirname(path) for path in deleted):
+            SegmentManifest(folder).compact()  # Forget the deleted segments
+        return len(doomed) == self.batch_size
+
+    # True once the clip is gone from disk and the catalog
+    def _delete(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            self.deleted += 1
+            self.deleted_bytes += size
+        except FileNotFoundError:
+            pass
+        except OSError as e:  ## if failed, report it back to the user ##
+            print("Error: %s - %s." % (e.filename, e.strerror))
+            self._failed.add(path)
+            return False
+        ClipIndex.remove(path)
+        self.catalog.remove(path)
+        return True
+
+
+_managers_lock = threading.Lock()
+_managers = {}
+
+
+def get_retention_manager(settings):
+    """The RetentionManager of the configured catalog, shared by every camera."""
+    path = settings.get('catalog_file', 'recordings.db')
+    with _managers_lock:
+        if path not in _managers:
+            _managers[path] = RetentionManager.from_settings(settings)
+        return _managers[path]
@@ -0,0 +1,58 @@
+import threading
+
+from posture import EAR_CLASSES, NOSE_CLASSES
+
+
+class RoiSelector:
+    """Picks the part of the frame the network runs on.
+
+    Once ear and nose have been found, the next detections run on a square around them
+    padded by padding head sizes on each side (never smaller than min_size pixels, so a
+    crop is not scaled up). The whole frame is searched every full_frame_every detections,
+    and as soon as a crop misses the ear or the nose.
+    """
+
+    def __init__(self, padding=1.0, full_frame_every=30, min_size=256):
+        self.padding = padding
+        self.full_frame_every = max(1, full_frame_every)
+        self.min_size = min_size
+        self.head = None  # x1, y1, x2, y2 around the last ear and nose, None until found
+        self.cropped = 0
+        self.full = 0
+        self.lost = 0  # Crops that missed the ear or the nose
+        self._since_full = 0
+        self._lock = threading.Lock()  # Workers of the inference pool detect concurrently
+
+    # (x, y, w, h) to crop, or None for the whole frame
+    def next_region(self, frame_width, frame_height):
+        with self._lock:
+            if self.head is not None and self._since_full < self.full_frame_every:
+                x1, y1, x2, y2 = self.head
+                size = int(max(max(x2 - x1, y2 - y1) * (1 + 2 * self.padding), self.min_size))
+                if size < min(frame_width, frame_height):
+                    self._since_full += 1
+                    self.cropped += 1
+                    x = min(max(0, (x1 + x2 - size) // 2), frame_width - size)
+                    y = min(max(0, (y1 + y2 - size) // 2), frame_height - size)
+                    return int(x), int(y), size, size
+            self._since_full = 0
+            self.full += 1
+            return None
+
+    # The detections of a region returned by next_region, boxes in frame coordinates
+    def update(self, region, detections):
+        bounding_box_ids, boxes, class_ids, confidence_values = detections
+        ears = [boxes[index] for index in bounding_box_ids if class_ids[index] in EAR_CLASSES]
+        noses = [boxes[index] for index in bounding_box_ids if class_ids[index] in NOSE_CLASSES]
+        with self._lock:
+            if not ears or not noses:
+                if region is not None:
+                    self.lost += 1
+                self.head = None
+                return
+            found = (ears[0], noses[0])  # NMS keeps the most confident first
+            self.head = (min(box[0] for box in found), min(box[1] for box in found),
+                         max(box[0] + box[2] for box in found), max(box[1] + box[3] for box in found))
+
+    def summary(self):
+        return "roi        %6d crops %6d full frame %6d lost" % (self.cropped, self.full, self.lost)
@@ -0,0 +1,98 @@
+import bisect
+import json
+import os
+import threading
+
+MANIFEST_FILE = 'segments.jsonl'
+
+_write_lock = threading.Lock()  # The recorder appends while retention compacts
+
+
+class Segment:
+    """One recorded segment: wall clock start and end, and its length in the file itself."""
+
+    def __init__(self, path, start, end, duration, frames=0, angle_min=None, angle_max=None, angle_mean=None):
+        self.path = path
+        self.start = start
+        self.end = end
+        self.duration = duration  # Seconds of video in the file, frames / the writer's fps
+        self.frames = frames
+        self.angle_min = angle_min
+        self.angle_max = angle_max
+        self.angle_mean = angle_mean
+
+    # Seconds into the file <-> wall clock, the file plays at its writer's fps rather than real time
+    def to_wall(self, offset):
+        if self.duration <= 0:
+            return self.start
+        return self.start + offset * (self.end - self.start) / self.duration
+
+    def to_offset(self, wall_time):
+        if self.end <= self.start:
+            return 0.0
+        return (min(max(wall_time, self.start), self.end) - self.start) * self.duration / (self.end - self.start)
+
+
+class SegmentManifest:
+    """segments.jsonl in a recording folder, one line per finished segment in recording order.
+
+    The recorder appends to it; the player reads it to play and seek across the segments
+    by wall clock time. Segments whose file is gone (retention) are skipped, compact()
+    drops them from the file.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.path = os.path.join(folder, MANIFEST_FILE)
+
+    def append(self, path, start, end, duration, frames, angles):
+        record = {'file': os.path.basename(path), 'start': round(start, 3), 'end': round(end, 3),
+                  'duration': round(duration, 3), 'frames': frames,
+                  'angle_min': angles.min, 'angle_max': angles.max, 'angle_mean': angles.mean()}
+        with _write_lock, open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def _records(self):
+        try:
+            with open(self.path) as f:
+                lines = f.readlines()
+        except OSError:
+            return []
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue  # Being written
+        return records
+
+    def segments(self):
+        segments = []
+        for record in self._records():
+            path = os.path.join(self.folder, record['file'])
+            if os.path.exists(path):
+                segments.append(Segment(path, record['start'], record['end'], record['duration'], record['frames'],
+                                        record['angle_min'], record['angle_max'], record['angle_mean']))
+        segments.sort(key=lambda segment: segment.start)
+        return segments
+
+    def compact(self):
+        with _write_lock:
+            if not os.path.exists(self.path):
+                return
+            records = [record for record in self._records()
+                       if os.path.exists(os.path.join(self.folder, record['file']))]
+            temporary = self.path + '.tmp'
+            with open(temporary, 'w') as f:
+                f.writelines(json.dumps(record) + '\n' for record in records)
+            os.replace(temporary, self.path)
+
+
+def locate(segments, wall_time):
+    """Index of the segment playing at wall_time, or of the next one when it falls in a gap;
+    None past the end."""
+    starts = [segment.start for segment in segments]
+    index = bisect.bisect_right(starts, wall_time) - 1
+    if index >= 0 and wall_time <= segments[index].end:
+        return index
+    return index + 1 if index + 1 < len(segments) else None
@@ -0,0 +1,74 @@
+import numpy as np
+from PyQt5.QtCore import Qt, pyqtSignal
+from PyQt5.QtGui import QColor, QPainter
+from PyQt5.QtWidgets import QWidget
+
+from posture import ANTERIOR_ANGLE, POSTERIOR_ANGLE
+
+ANGLE_RANGE = 45  # Degrees either side of level shown on the timeline
+GOOD_COLOR = QColor(80, 200, 80)
+POOR_COLOR = QColor(230, 60, 60)
+
+
+class AngleTimeline(QWidget):
+    """The angle of every frame of a clip as one bar per pixel column, poor posture in red.
+
+    Only the frames under a column are read from the (memory mapped) angle array, so long
+    clips draw as fast as short ones. Clicking asks to seek, moving the mouse to preview.
+    """
+    seekRequested = pyqtSignal(float)  # Fraction of the clip
+    hovered = pyqtSignal(float)
+
+    def __init__(self, parent=None):
+        super(AngleTimeline, self).__init__(parent)
+        self.angles = None
+        self.position = 0.0
+        self.setMinimumHeight(48)
+        self.setMaximumHeight(64)
+        self.setMouseTracking(True)
+
+    def setAngles(self, angles):
+        self.angles = angles
+        self.update()
+
+    def setPosition(self, fraction):
+        self.position = fraction
+        self.update()
+
+    def _fraction(self, event):
+        return min(1.0, max(0.0, event.x() / max(1, self.width() - 1)))
+
+    # @Override
+    def mousePressEvent(self, event):
+        if self.angles is not None:
+            self.seekRequested.emit(self._fraction(event))
+
+    # @Override
+    def mouseMoveEvent(self, event):
+        if self.angles is not None:
+            self.hovered.emit(self._fraction(event))
+
+    # @Override
+    def paintEvent(self, event):
+        qp = QPainter()
+        qp.begin(self)
+        width, height = self.width(), self.height()
+        middle = height // 2
+        qp.fillRect(0, 0, width, height, QColor(30, 30, 30))
+        if self.angles is not None and len(self.angles):
+            columns = np.asarray(self.angles[np.linspace(0, len(self.angles) - 1, width).astype(np.int64)])
+            scale = (height / 2 - 1) / ANGLE_RANGE
+            qp.setPen(QColor(90, 90, 90))
+            for limit in (POSTERIOR_ANGLE, ANTERIOR_ANGLE):
+                y = int(middle + limit * scale)
+                qp.drawLine(0, y, width, y)
+            for x, angle in enumerate(columns):
+                if np.isnan(angle):
+                    continue  # Head not found
+                poor = angle < POSTERIOR_ANGLE or angle > ANTERIOR_ANGLE
+                qp.setPen(POOR_COLOR if poor else GOOD_COLOR)
+                qp.drawLine(x, middle, x, int(middle + max(-ANGLE_RANGE, min(ANGLE_RANGE, angle)) * scale))
+        qp.setPen(Qt.white)
+        x = int(self.position * (width - 1))
+        qp.drawLine(x, 0, x, height)
+        qp.end()
@@ -1,224 +1,179 @@
-import glob
-
 from cv2 import cv2
-import numpy as np
 import time
 import os
 import yaml
 from munch import munchify
 from datetime import datetime
 
+import posture
+from alerts import get_alerts
+from event_log import get_event_log
+from posture import (ALARM_SECONDS, ANTERIOR_ANGLE, POSTERIOR_ANGLE, SUPPRESSION_THRESHOLD, THRESHOLD,
+                     YOLO_IMAGE_SIZE, PostureTimer)
+from recorder import RecorderService
+from recording_catalog import get_catalog
+from segments import SegmentManifest
+
 
 class YoloVideoSelf:
-    def __init__(self):
+    def __init__(self, recorder=None, alerts=None, camera_name=None, events=None, retention=None, settings=None):
         print("************  Init YoloVideoSelf ************")
-        settings = munchify(yaml.safe_load(open("config/config.yml")))
+        if settings is None:
+            settings = munchify(yaml.safe_load(open("config/config.yml")))
         self.RECORD_FOLDER_POOR = settings.record_folder_poor
         self.RECORD_FOLDER_GOOD = settings.record_folder_good
+        self.cameraName = camera_name
+        if camera_name is not None:
+            # With several cameras each one records into its own folders, e.g. record_camera1
+            self.RECORD_FOLDER_POOR += '_' + camera_name
+            self.RECORD_FOLDER_GOOD += '_' + camera_name
+            for folder in (self.RECORD_FOLDER_POOR, self.RECORD_FOLDER_GOOD):
+                os.makedirs(folder, exist_ok=True)
         self.poorPostureFile = None
         self.goodPostureFile = None
 
-        self.THRESHOLD = 0.2
+        self.THRESHOLD = THRESHOLD
         # the lower the value: the fewer bounding boxes will remain
-        self.SUPPRESSION_THRESHOLD = 0.4
-        self.YOLO_IMAGE_SIZE = 416
-        self.startPoorPostureTimer = time.time()
+        self.SUPPRESSION_THRESHOLD = SUPPRESSION_THRESHOLD
+        self.YOLO_IMAGE_SIZE = YOLO_IMAGE_SIZE
         self.startGoodPostureTimer = time.time()
-        self.poorPostureTimerStarted = False
+        self.frameTime = time.time()  # Capture time of the frame being annotated
+        self.postureTimer = PostureTimer(ALARM_SECONDS)  # Poor posture held this long sounds the alarm
         self.goodPostureTimerStarted = False
 
         # Video Capture
         # Width and height of frame
         self.width = None
         self.height = None
-        # Define the codec and create VideoWriter object
+        # Define the codec, the VideoWriters live on the recorder thread
         self.codec = None
-        self.poorPostureVideoWriter = None
-        self.goodPostureVideoWriter = None
-
-        self.freezeVideoTime = 3
-        self.posteriorAngle = -13
-        self.anteriorAngle = 12
-
-    def processFrame(self, frame, neural_network):
-        original_width, original_height = frame.shape[1], frame.shape[0]
-        #  print('Dim ' + str(original_width) + ' ' + str(original_width))
-        # the image into a BLOB [0-1] RGB - BGR
-        blob = cv2.dnn.blobFromImage(frame, 1 / 255, (self.YOLO_IMAGE_SIZE, self.YOLO_IMAGE_SIZE), True, crop=False)
-        neural_network.setInput(blob)
-
-        layer_names = neural_network.getLayerNames()
-        # YOLO network has 3 output layer - note: these indexes are starting with 1
-
-        # output_names = [layer_names[index[0] - 1] for index in neural_network.getUnconnectedOutLayers()]
-        output_names = [layer_names[65], layer_names[77]]
-
-        model_outputs = neural_network.forward(output_names)
-        predicted_objects, bbox_locations, class_label_ids, conf_values = self.find_objects(model_outputs)
-        self.show_detected_objects(frame, predicted_objects, bbox_locations, class_label_ids, conf_values,
-                                   original_width / self.YOLO_IMAGE_SIZE, original_height / self.YOLO_IMAGE_SIZE)
-
-        return frame
-
-    def find_objects(self, model_outputs):
-        bounding_box_locations = []
-        class_ids = []
-        confidence_values = []
-
-        for output in model_outputs:
-            for prediction in output:
-                class_probabilities = prediction[5:]
-                class_id = np.argmax(class_probabilities)
-                confidence = class_probabilities[class_id]
-
-                if confidence > self.THRESHOLD:
-                    w, h = int(prediction[2] * self.YOLO_IMAGE_SIZE), int(prediction[3] * self.YOLO_IMAGE_SIZE)
-                    # the center of the bounding box (we should transform these values)
-                    x, y = int(prediction[0] * self.YOLO_IMAGE_SIZE - w / 2), int(
-                        prediction[1] * self.YOLO_IMAGE_SIZE - h / 2)
-                    bounding_box_locations.append([x, y, w, h])
-                    class_ids.append(class_id)
-                    confidence_values.append(float(confidence))
-
-        box_indexes_to_keep = cv2.dnn.NMSBoxes(bounding_box_locations, confidence_values, self.THRESHOLD,
-                                               self.SUPPRESSION_THRESHOLD)
-
-        return box_indexes_to_keep, bounding_box_locations, class_ids, confidence_values
-
+        self.recorder = recorder if recorder is not None else RecorderService(catalog=get_catalog(settings))
+
+        self.alerts = alerts if alerts is not None else get_alerts(settings)
+        self.events = events if events is not None else get_event_log(settings)
+        self.retention = retention  # RetentionManager keeping the folders in budget, None keeps everything
+        # Good posture is recorded in segments of this many seconds, listed in the folder's manifest
+        self.segmentSeconds = settings.get('segment_seconds', 10)
+        self.goodManifest = SegmentManifest(self.RECORD_FOLDER_GOOD)
+
+        self.freezeVideoTime = 3  # Seconds the Heads-Up banner stays on the video after an alarm
+        self.alertBannerUntil = 0
+        self.posteriorAngle = POSTERIOR_ANGLE
+        self.anteriorAngle = ANTERIOR_ANGLE
+        self.angle = None  # Ear-nose angle of the last annotated frame, None when the head was not found
+
+    # See posture.detect, with this instance's thresholds
+    def detect(self, frame, model, timings=None, region=None, input_size=None):
+        return posture.detect(frame, model, timings, region, input_size, self.THRESHOLD, self.SUPPRESSION_THRESHOLD)
+
+    # timestamp is when the frame was captured (time.time() clock), the posture timers run on it
+    # so they do not depend on how long the frame took to get here; None means now
     def show_detected_objects(self, img, bounding_box_ids, all_bounding_boxes, class_ids, confidence_values,
-                              width_ratio,
-                              height_ratio):
-        ear = (0, 0)
-        nose = (0, 0)
-        earFound = False
-        noseFound = False
-        for index in bounding_box_ids:
-            bounding_box = all_bounding_boxes[index]
-            x1, y1, w, h = int(bounding_box[0]), int(bounding_box[1]), int(bounding_box[2]), int(bounding_box[3])
-            # we have to transform the locations adn coordinates because the resized image
-            x = int(x1 * width_ratio)
-            y = int(y1 * height_ratio)
-            w = int(w * width_ratio)
-            h = int(h * height_ratio)
-
+                              width_ratio=1,
+                              height_ratio=1, timestamp=None):
+        self.frameTime = timestamp if timestamp is not None else time.time()
+        boxes = posture.head_boxes(bounding_box_ids, all_bounding_boxes, class_ids, confidence_values, width_ratio,
+                                   height_ratio)
+        for kind, (x, y, w, h), confidence in boxes:
             # OpenCV deals with BGR blue green red (255,0,0) then it is the blue color
-            # we are not going to detect every objects just PERSON and CAR
-            if class_ids[index] == 1 or class_ids[index] == 2:
-                noseFound = True
-                nose = (x + (w // 2), y + (h // 2))
-                cv2.rectangle(img, (x, y), (x + w, y + h), (0, 0, 255), 3)
-                class_with_confidence = 'NOSE ' + str(int(confidence_values[index] * 100)) + '%'
-                cv2.putText(img, class_with_confidence, (x, y - 10), cv2.FONT_HERSHEY_PLAIN, 2, (0, 0, 255), 2)
-
-            if class_ids[index] == 0:
-                earFound = True
-                ear = (x + (w // 2), y + (h // 2))
-                cv2.rectangle(img, (x, y), (x + w, y + h), (255, 255, 255), 3)
-                class_with_confidence = 'EAR ' + str(int(confidence_values[index] * 100)) + '%'
-                cv2.putText(img, class_with_confidence, (x, y - 10), cv2.FONT_HERSHEY_PLAIN, 2, (255, 255, 255), 2)
-
-        if earFound & noseFound:
-            slope = self.slopeOf(ear[0], ear[1], nose[0], nose[1])
-            angle = np.arctan(slope) * 57.2958
+            color = (0, 0, 255) if kind == 'nose' else (255, 255, 255)
+            cv2.rectangle(img, (x, y), (x + w, y + h), color, 3)
+            class_with_confidence = kind.upper() + ' ' + str(int(confidence * 100)) + '%'
+            cv2.putText(img, class_with_confidence, (x, y - 10), cv2.FONT_HERSHEY_PLAIN, 2, color, 2)
+
+        ear, nose, self.angle = posture.head_angle(boxes)
+        if self.angle is not None:
+            angle = self.angle
             cv2.putText(img, 'Angle :' + str(int(angle)), (1500, 1000), cv2.FONT_HERSHEY_PLAIN, 3, (255, 255, 255), 3)
             cv2.line(img, nose, ear, (255, 255, 255), 3)
 
-            now = datetime.now().time()  # time object
+            now = datetime.fromtimestamp(self.frameTime).time()  # time object
             current_time = now.strftime("%H:%M:%S")
 
-            poorPosture = angle < self.posteriorAngle or angle > self.anteriorAngle
-            if poorPosture:
-                # print('Angle is ' + str(int(angle)) + '  at ' + current_time)
-                if not self.poorPostureTimerStarted:
-                    self.poorPostureTimerStarted = True
-                    self.startPoorPostureTimer = time.time()
-                    print("************ Timer started now =", current_time + '************')
-                    # os.makedirs(self.folder)  # important step
-                    self.poorPostureFile = datetime.now().strftime('%Y-%m-%d__%H-%M-%S') + '.mp4'
-                    self.poorPostureVideoWriter = cv2.VideoWriter(
-                        os.path.join(self.RECORD_FOLDER_POOR, self.poorPostureFile),
-                        self.codec, 10.0, (self.width, self.height))
-                timedOut = time.time() - self.startPoorPostureTimer > 5
-                # print('timed out ' + str(timedOut))
-                if timedOut and self.poorPostureTimerStarted:
-                    # sound alarm, reset timer,  release video writer
-                    self.handleBadPostureAlarm(current_time, img)
-            else:  # NOT angle < -12 or angle > 14
-                if self.poorPostureTimerStarted:  # We were in poor posture
-                    self.handleReturnedToGoodPosture()
+            event = self.postureTimer.update(self.isPoorPosture(angle), self.frameTime)
+            if event == 'poor_start':
+                self.logEvent('poor_start', angle=round(angle, 1))
+                # Good frames stop here, a segment must not span the gap or its wall clock times are off
+                self.closeGoodPostureClip()
+                # Nothing is encoded yet, the clip is cut from the pre-roll buffer if the alarm fires
+                self.poorPostureFile = (datetime.fromtimestamp(self.frameTime).strftime('%Y-%m-%d__%H-%M-%S')
+                                        + '.mp4')
+            elif event == 'alarm':
+                # sound alarm, reset timer,  release video writer
+                self.handleBadPostureAlarm(current_time, img)
+            elif event == 'returned_good':  # We were in poor posture
+                self.handleReturnedToGoodPosture()
+            if not self.postureTimer.started and self.goodPostureFile is None:
                 # Good posture
-                # self.startGoodPostureTimer = time.time()
-                if self.goodPostureVideoWriter is None:
-                    self.createGoodPostureWriter1()
+                self.createGoodPostureWriter1()
 
-        if self.poorPostureTimerStarted:
-            self.poorPostureVideoWriter.write(img)
-        else:
-            if self.goodPostureVideoWriter is None:
+        if self.frameTime < self.alertBannerUntil:
+            cv2.putText(img, 'Heads-Up', (1500, 950), cv2.FONT_HERSHEY_PLAIN, 3, (255, 255, 0), 3)
+        self.recorder.buffer(img, self.frameTime, self.angle)
+        if not self.postureTimer.started:
+            if self.goodPostureFile is None:
                 self.createGoodPostureWriter2()
-            self.goodPostureVideoWriter.write(img)
-            if time.time() - self.startGoodPostureTimer > 10:
-                self.goodPostureVideoWriter.release()
-                self.goodPostureVideoWriter = None
-                self.startGoodPostureTimer = time.time()  # Reset timer
-                print("************ released createGoodPostureWriter ************")
+            self.recorder.write('good', img, self.angle, self.frameTime)
+            if self.frameTime - self.startGoodPostureTimer > self.segmentSeconds:
+                self.closeGoodPostureClip()
+                self.startGoodPostureTimer = self.frameTime  # Reset timer
+
+    # The next good frame opens a new segment
+    def closeGoodPostureClip(self):
+        if self.goodPostureFile is None:
+            return
+        self.recorder.release('good')
+        self.logEvent('good_clip_end', clip=os.path.join(self.RECORD_FOLDER_GOOD, self.goodPostureFile))
+        self.goodPostureFile = None
 
     def createGoodPostureWriter1(self):
-        print("************ createGoodPostureWriter 1 ************")
-
-        self.deleteExcessGoodVideos()
-        self.startGoodPostureTimer = time.time()
-        self.goodPostureFile = datetime.now().strftime('%Y-%m-%d__%H-%M-%S') + '.mp4'
-        self.goodPostureVideoWriter = cv2.VideoWriter(os.path.join(self.RECORD_FOLDER_GOOD, self.goodPostureFile),
-                                                      self.codec, 10.0, (self.width, self.height))
-        if self.goodPostureVideoWriter is None:
-            print("************ Failed to create createGoodPostureWriter 1 ************")
+        self.requestRetention()
+        self.startGoodPostureTimer = self.frameTime
+        self.goodPostureFile = self.segmentFileName()
+        path = os.path.join(self.RECORD_FOLDER_GOOD, self.goodPostureFile)
+        self.recorder.open('good', path, self.codec, 10.0, (self.width, self.height), self.goodManifest)
+        self.logEvent('good_clip_start', clip=path, angle=round(self.angle, 1))
 
     def createGoodPostureWriter2(self):
-        print("************ createGoodPostureWriter 2 ************")
-        self.deleteExcessGoodVideos()
+        self.requestRetention()
 
-        self.startGoodPostureTimer = time.time()
-        self.goodPostureFile = datetime.now().strftime('%Y-%m-%d__%H-%M-%S') + '.mp4'
-        self.goodPostureVideoWriter = cv2.VideoWriter(os.path.join(self.RECORD_FOLDER_GOOD, self.goodPostureFile),
-                                                      self.codec, 10.0, (self.width, self.height))
-        if self.goodPostureVideoWriter is None:
-            print("************ Failed to create createGoodPostureWriter 2 ************")
+        self.startGoodPostureTimer = self.frameTime
+        self.goodPostureFile = self.segmentFileName()
+        path = os.path.join(self.RECORD_FOLDER_GOOD, self.goodPostureFile)
+        self.recorder.open('good', path, self.codec, 10.0, (self.width, self.height), self.goodManifest)
+        self.logEvent('good_clip_start', clip=path, angle=round(self.angle, 1) if self.angle is not None else None)
+
+    # Named after the capture time of its first frame, the one being annotated; with milliseconds,
+    # short segments can start within the same second
+    def segmentFileName(self):
+        return datetime.fromtimestamp(self.frameTime).strftime('%Y-%m-%d__%H-%M-%S-%f')[:-3] + '.mp4'
 
     def handleReturnedToGoodPosture(self):
-        self.poorPostureTimerStarted = False
-        self.poorPostureVideoWriter.release()
-        self.poorPostureVideoWriter = None
-        try:
-            recordFolderPath = os.path.dirname(os.path.abspath(__file__)) + self.RECORD_FOLDER_POOR
-            # debug  print(str(os.path.join(recordFolderPath, self.recordFileName)))
-            if os.path.isfile(os.path.join(self.RECORD_FOLDER_POOR, self.poorPostureFile)):
-                os.remove(os.path.join(self.RECORD_FOLDER_POOR, self.poorPostureFile))
-        except OSError as e:  ## if failed, report it back to the user ##
-            print("Error: %s - %s." % (e.filename, e.strerror))
-        print('********  reset timer ************')
+        # Corrected in time, no clip is written
+        self.logEvent('returned_good', angle=round(self.angle, 1),
+                      seconds=round(self.postureTimer.seconds(self.frameTime), 1))
 
     def handleBadPostureAlarm(self, current_time, img):
-        print("************ Timed out ", current_time + '************')
-        cv2.putText(img, 'Heads-Up', (1500, 1000), cv2.FONT_HERSHEY_PLAIN, 3, (255, 255, 0), 3)
-        file = "3.wav"
-        os.system("afplay " + file)
-        print('*************** wav *******************')
-        time.sleep(self.freezeVideoTime)
-        self.poorPostureTimerStarted = False
-        self.poorPostureVideoWriter.release()
-        self.poorPostureVideoWriter = None
-
-    def slopeOf(self, x1, y1, x2, y2):
-        m = (y2 - y1) / (x2 - x1)
-        return m
-
-    def deleteExcessGoodVideos(self):
-        currentDir = os.path.dirname(os.path.abspath(__file__))
-        list_of_files = glob.glob(currentDir + '/' + self.RECORD_FOLDER_GOOD + '/*')
-        full_path = ["{0}".format(x) for x in list_of_files]
-
-        while len(list_of_files) > 5:
-            oldest_file = min(full_path, key=os.path.getctime)
-            list_of_files.remove(oldest_file)
-            os.remove(oldest_file)
\ No newline at end of file
+        path = os.path.join(self.RECORD_FOLDER_POOR, self.poorPostureFile)
+        self.logEvent('alarm', angle=round(self.angle, 1), clip=path)
+        self.recorder.save_preroll(path, self.codec)
+        # Never blocks: the sound plays on the alert thread and the banner is drawn on the following frames
+        if self.cameraName is not None:
+            self.alerts.alert("Poor posture at %s on %s" % (current_time, self.cameraName))
+        else:
+            self.alerts.alert("Poor posture at " + current_time)
+        self.alertBannerUntil = self.frameTime + self.freezeVideoTime
+
+    # Posture event for the event log, tagged with the camera when there are several
+    def logEvent(self, event, **fields):
+        if self.cameraName is not None:
+            fields['camera'] = self.cameraName
+        self.events.log(event, **fields)
+
+    def isPoorPosture(self, angle):
+        return posture.is_poor_posture(angle, self.posteriorAngle, self.anteriorAngle)
+
+    # A good clip was just finished, the retention thread deletes the excess ones in the background
+    def requestRetention(self):
+        if self.retention is not None:
+            self.retention.request()
@@ -0,0 +1,112 @@
+import time
+
+import cv2
+import numpy as np
+
+from inference_backends import create_backend, resolve_backend
+
+WEIGHTS_FILE = "config/yolov4-tiny_best-5.weights"
+CFG_FILE = "config/yolov4-tiny-5.cfg"
+
+
+def read_input_size(cfg_file):
+    """Network input (width, height) from the [net] section of a darknet cfg."""
+    size = {'width': 416, 'height': 416}
+    with open(cfg_file) as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if line.startswith('[') and line != '[net]':
+                break
+            key, _, value = line.partition('=')
+            if key.strip() in size:
+                size[key.strip()] = int(value)
+    return size['width'], size['height']
+
+
+def settings_input_size(settings):
+    """Network input (width, height) YoloModel.from_settings runs at, without loading the model."""
+    input_size = settings.get('inference_input_size')
+    if input_size:
+        return input_size, input_size
+    return read_input_size(settings.get('model_cfg', CFG_FILE))
+
+
+class YoloModel:
+    """A network on one of the inference backends together with everything that can be worked
+    out once: the backend's output layers and the buffers the input frame is packed into."""
+
+    def __init__(self, weights_file=WEIGHTS_FILE, cfg_file=CFG_FILE, backend='opencv', onnx_file=None,
+                 input_size=None):
+        self.weights_file = weights_file
+        self.cfg_file = cfg_file
+        # The YOLO layers adapt to any input that is a multiple of 32, smaller is faster but less accurate
+        if input_size:
+            self.input_width = self.input_height = input_size
+        else:
+            self.input_width, self.input_height = read_input_size(cfg_file)
+        self.backend = create_backend(backend, weights_file, cfg_file, onnx_file)
+
+        self._resized = np.empty((self.input_height, self.input_width, 3), dtype=np.uint8)
+        self._blob = np.empty((1, 3, self.input_height, self.input_width), dtype=np.float32)
+        self._batch_blobs = {}  # Batch size -> preallocated blob
+        self._sized = {}  # Other input size, e.g. for ROI crops -> (resized, blob)
+
+    @classmethod
+    def from_settings(cls, settings):
+        weights_file = settings.get('model_weights', WEIGHTS_FILE)
+        cfg_file = settings.get('model_cfg', CFG_FILE)
+        onnx_file = settings.get('model_onnx')
+        input_size = settings.get('inference_input_size')
+        backend = resolve_backend(settings.get('inference_backend', 'opencv'), weights_file, cfg_file, onnx_file,
+                                  settings_input_size(settings), settings.get('backend_probe_frames', 5))
+        return cls(weights_file, cfg_file, backend, onnx_file, input_size)
+
+    # Same blob as the old cv2.dnn.blobFromImage(frame, 1 / 255, size, True, crop=False) without allocating.
+    # That call passed True as the mean rather than swapRB, so the network is fed BGR minus (1, 0, 0).
+    # input_size other than the model's own is for the cv2.dnn backends, which reshape the network
+    # to fit; an ONNX model would need to be exported with a dynamic input size
+    def preprocess(self, frame, input_size=None):
+        if not input_size or (input_size, input_size) == (self.input_width, self.input_height):
+            self._pack(frame, self._blob[0])
+            return self._blob
+        buffers = self._sized.get(input_size)
+        if buffers is None:
+            buffers = self._sized[input_size] = (np.empty((input_size, input_size, 3), dtype=np.uint8),
+                                                 np.empty((1, 3, input_size, input_size), dtype=np.float32))
+        resized, blob = buffers
+        self._pack(frame, blob[0], resized)
+        return blob
+
+    def preprocess_batch(self, frames):
+        blob = self._batch_blobs.get(len(frames))
+        if blob is None:
+            blob = np.empty((len(frames), 3, self.input_height, self.input_width), dtype=np.float32)
+            self._batch_blobs[len(frames)] = blob
+        for frame, out in zip(frames, blob):
+            self._pack(frame, out)
+        return blob
+
+    def _pack(self, frame, out, resized=None):
+        resized = self._resized if resized is None else resized
+        cv2.resize(frame, (resized.shape[1], resized.shape[0]), dst=resized)
+        np.multiply(resized.transpose(2, 0, 1), 1 / 255, out=out, casting='unsafe')
+        out[0] -= 1 / 255
+
+    # timings, when given, receives the seconds spent in 'preprocess' and 'forward'
+    def forward(self, frame, timings=None, input_size=None):
+        start = time.perf_counter()
+        blob = self.preprocess(frame, input_size)
+        preprocessed = time.perf_counter()
+        outputs = self.backend.run(blob)
+        if timings is not None:
+            timings['preprocess'] = preprocessed - start
+            timings['forward'] = time.perf_counter() - preprocessed
+        return outputs
+
+    # One forward pass over several frames, returns the outputs of each frame in order.
+    # ONNX models need to have been exported with a dynamic batch dimension for this.
+    def forward_batch(self, frames):
+        outputs = self.backend.run(self.preprocess_batch(frames))
+        # (N, rows, columns) from recent OpenCV and ONNX Runtime, (N * rows, columns) from older OpenCV
+        outputs = [output.reshape(len(frames), -1, output.shape[-1]) for output in outputs]
+        return [[output[i] for output in outputs] for i in range(len(frames))]